@@ -1,6 +1,37 @@
-from flask import jsonify
+import threading
+
+from flask import jsonify, request
 
 from api.app import app
+from api.batching import MicroBatcher
+from api.router import router
+
+_batcher = None
+_batcher_lock = threading.Lock()
+
+
+def get_batcher():
+    """The `MicroBatcher` around the shared `RetreiveQADoc`, built on first use."""
+    global _batcher
+    with _batcher_lock:
+        if _batcher is None:
+            from config.consts import FS
+            from diagnosis.models.docproduct.predictor import RetreiveQADoc
+
+            doc = RetreiveQADoc(
+                pretrained_path=app.config.get(
+                    'RETRIEVE_PRETRAINED_PATH', FS.PRE_TRAINED.PUB_MED),
+                bert_ffn_weight_file=app.config.get(
+                    'RETRIEVE_BERT_FFN_WEIGHT_FILE', FS.MODELS.BERT_FFN),
+                embedding_file=app.config.get(
+                    'RETRIEVE_EMBEDDING_FILE', FS.EMBEDDINGS.BERT_FFN_STORE),
+                search_modes=app.config.get(
+                    'RETRIEVE_SEARCH_MODES', ('answer', 'question')))
+            _batcher = MicroBatcher(
+                doc.predict_batch,
+                max_batch_size=app.config.get('RETRIEVE_MAX_BATCH_SIZE', 32),
+                max_wait_ms=app.config.get('RETRIEVE_MAX_WAIT_MS', 5))
+        return _batcher
 
 
 @app.route('/', methods=['GET'])
@@ -10,3 +41,38 @@ def api_index():
         'error': None,
     }
     return jsonify(resp)
+
+
+@router.api('/retrieve', methods=['POST'])
+def api_retrieve():
+    data = request.get_json(silent=True) or {}
+    question = data.get('question')
+    search_by = data.get('search_by', 'answer')
+    topk = data.get('topk', 5)
+    answer_only = data.get('answer_only', True)
+    search_modes = app.config.get('RETRIEVE_SEARCH_MODES', ('answer', 'question'))
+    max_topk = app.config.get('RETRIEVE_MAX_TOPK', 100)
+
+    error = None
+    if not isinstance(question, str) or not question.strip():
+        error = '`question` must be a non-empty string.'
+    elif search_by not in search_modes:
+        error = '`search_by` must be one of {0}.'.format(
+            ', '.join('"{0}"'.format(mode) for mode in search_modes))
+    elif isinstance(topk, bool) or not isinstance(topk, int) or not 1 <= topk <= max_topk:
+        error = '`topk` must be an integer between 1 and {0}.'.format(max_topk)
+    elif not isinstance(answer_only, bool):
+        error = '`answer_only` must be true or false.'
+    if error is not None:
+        return jsonify({'status': 400, 'error': error}), 400
+
+    output = get_batcher().predict(question, search_by, topk, answer_only)
+    resp = {
+        'status': 200,
+        'error': None,
+    }
+    if answer_only:
+        resp['answers'] = output
+    else:
+        resp['questions'], resp['answers'] = output
+    return jsonify(resp)
@@ -22,4 +22,4 @@ app = Flask(__name__)
 
 # App confnigurations.
 app.config.from_pyfile('config.cfg', silent=True)
-app.config.from_object('config.Development')
+app.config.from_object('api.config.Development')
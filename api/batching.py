@@ -0,0 +1,117 @@
+"""Micro-batching of concurrent retrieval requests.
+
+   @author
+     Victor I. Afolabi
+     Artificial Intelligence Expert & Researcher.
+     Email: javafolabi@gmail.com
+     GitHub: https://github.com/victor-iyiola
+
+   @project
+     File: batching.py
+     Package: api
+     Created on 10 July, 2019 @ 02:19 PM.
+
+   @license
+     BSD-3 Clause license.
+     Copyright (c) 2019. Victor I. Afolabi. All rights reserved.
+"""
+import queue
+import threading
+import time
+
+from collections import defaultdict
+from concurrent.futures import Future
+
+__all__ = ['MicroBatcher']
+
+
+class MicroBatcher(object):
+    """Collects concurrent questions into batches for `predict_batch`.
+
+    A worker thread takes up to `max_batch_size` queued questions, waiting
+    at most `max_wait_ms` after the first one, and answers all of them
+    with a single `predict_batch` call per (search_by, answer_only) pair.
+
+    Arguments:
+        predict_batch (callable): `RetreiveQADoc.predict_batch` or any
+            function with the same signature.
+        max_batch_size (int): Most questions in one batch.
+        max_wait_ms (float): Longest a question waits for others to join.
+
+    Examples:
+        ```python
+        >>> batcher = MicroBatcher(doc.predict_batch, max_batch_size=32)
+        >>> batcher.predict('my eyes hurt.', search_by='answer', topk=5)
+        ```
+    """
+
+    def __init__(self, predict_batch, max_batch_size=32, max_wait_ms=5):
+        self.predict_batch = predict_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self._queue = queue.Queue()
+        self._worker = threading.Thread(target=self._run, daemon=True)
+        self._worker.start()
+
+    def submit(self, question, search_by='answer', topk=5, answer_only=True):
+        """Queues `question`, returns a `Future` of its `predict` result."""
+        future = Future()
+        self._queue.put((question, search_by, topk, answer_only, future))
+        return future
+
+    def predict(self, question, search_by='answer', topk=5, answer_only=True):
+        """Blocks until the batch holding `question` has run."""
+        return self.submit(question, search_by, topk, answer_only).result()
+
+    def _next_batch(self):
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            groups = defaultdict(list)
+            for request in self._next_batch():
+                groups[request[1], request[3]].append(request)
+
+            for (search_by, answer_only), requests in groups.items():
+                try:
+                    self._run_group(requests, search_by, answer_only)
+                except Exception as e:
+                    if len(requests) == 1:
+                        requests[0][-1].set_exception(e)
+                        continue
+                    # retried one by one, so an error only fails the
+                    # requests that cause it; the worker keeps running.
+                    for r in requests:
+                        try:
+                            self._run_group([r], search_by, answer_only)
+                        except Exception as e:
+                            r[-1].set_exception(e)
+
+    def _run_group(self, requests, search_by, answer_only):
+        # one search with the largest topk, sliced per caller.
+        topk = max(r[2] for r in requests)
+        outputs = self.predict_batch(
+            [r[0] for r in requests], search_by, topk, answer_only)
+        if len(outputs) != len(requests):
+            raise ValueError('predict_batch returned {0} outputs for {1} questions.'.format(
+                len(outputs), len(requests)))
+
+        results = []
+        for r, output in zip(requests, outputs):
+            if answer_only:
+                output = output[:r[2]]
+            else:
+                output = tuple(o[:r[2]] for o in output)
+            results.append(output)
+        for r, output in zip(requests, results):
+            r[-1].set_result(output)
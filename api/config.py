@@ -9,6 +9,13 @@ class Config(object):
     DEBUG = False
     TESTING = False
     SECRET_KEY = secrets.token_hex(32)
+    # /api/retrieve batches concurrent questions, see `api.batching`.
+    RETRIEVE_MAX_BATCH_SIZE = 32
+    RETRIEVE_MAX_WAIT_MS = 5
+    # every request of a batch is searched with the batch's largest topk.
+    RETRIEVE_MAX_TOPK = 100
+    # indexes loaded by `RetreiveQADoc`, other `search_by` values are refused.
+    RETRIEVE_SEARCH_MODES = ('answer', 'question')
     # DATABASE_URI = 'sqlite: // : memory:'
 
 
@@ -17,6 +17,7 @@
 """
 import unittest
 from api.app import app
+import api.api  # noqa: F401, registers the routes.
 
 
 class TestApp(unittest.TestCase):
@@ -26,3 +27,16 @@ class TestApp(unittest.TestCase):
 
         response = client.get('/')
         assert response.status_code == 200
+
+    def test_retrieve_validation(self):
+        app.testing = True
+        client = app.test_client()
+
+        for body in ({'question': 'my eyes hurt', 'topk': 10 ** 8},
+                     {'question': 'my eyes hurt', 'topk': True},
+                     {'question': 'my eyes hurt', 'answer_only': 'false'},
+                     {'question': 'my eyes hurt', 'search_by': 'title'},
+                     {'question': ' '}):
+            response = client.post('/api/retrieve', json=body)
+            assert response.status_code == 400, body
+            assert response.get_json()['error']
@@ -0,0 +1,89 @@
+"""Tests for micro-batching of retrieval requests.
+
+   @project
+     File: test_batching.py
+     Package: api.tests
+
+   @license
+     BSD-3 Clause license.
+     Copyright (c) 2019. Victor I. Afolabi. All rights reserved.
+"""
+import threading
+import unittest
+
+from api.batching import MicroBatcher
+
+
+class FakeRetriever(object):
+    """`predict_batch` answering question q with q-0 ... q-(topk - 1)."""
+
+    def __init__(self, fail_on=None, drop_output=False):
+        self.calls = []
+        self.fail_on = fail_on
+        self.drop_output = drop_output
+        self.lock = threading.Lock()
+
+    def predict_batch(self, questions, search_by, topk, answer_only):
+        with self.lock:
+            self.calls.append((list(questions), search_by, topk, answer_only))
+        if self.fail_on in questions:
+            raise RuntimeError('search failed')
+        answers = [['{0}-{1}'.format(q, i) for i in range(topk)] for q in questions]
+        if not answer_only:
+            answers = [(a, [s.upper() for s in a]) for a in answers]
+        return answers[:-1] if self.drop_output else answers
+
+
+class TestMicroBatcher(unittest.TestCase):
+    def test_batches_concurrent_requests(self):
+        retriever = FakeRetriever()
+        batcher = MicroBatcher(retriever.predict_batch,
+                               max_batch_size=8, max_wait_ms=200)
+        futures = [batcher.submit('q{0}'.format(i), topk=1 + i % 3)
+                   for i in range(8)]
+        for i, future in enumerate(futures):
+            self.assertEqual(future.result(timeout=5),
+                             ['q{0}-{1}'.format(i, j) for j in range(1 + i % 3)])
+        # one call, with the largest topk.
+        self.assertEqual(len(retriever.calls), 1)
+        self.assertEqual(retriever.calls[0][2], 3)
+
+    def test_groups_by_search_mode(self):
+        retriever = FakeRetriever()
+        batcher = MicroBatcher(retriever.predict_batch,
+                               max_batch_size=4, max_wait_ms=200)
+        answer = batcher.submit('a', search_by='answer', topk=2)
+        question = batcher.submit('b', search_by='question', topk=1,
+                                  answer_only=False)
+        self.assertEqual(answer.result(timeout=5), ['a-0', 'a-1'])
+        self.assertEqual(question.result(timeout=5), (['b-0'], ['B-0']))
+        self.assertEqual(sorted(call[1] for call in retriever.calls),
+                         ['answer', 'question'])
+
+    def test_errors_fail_only_their_requests(self):
+        retriever = FakeRetriever(fail_on='bad')
+        batcher = MicroBatcher(retriever.predict_batch,
+                               max_batch_size=2, max_wait_ms=200)
+        bad = batcher.submit('bad')
+        other = batcher.submit('other')
+        with self.assertRaises(RuntimeError):
+            bad.result(timeout=5)
+        self.assertEqual(other.result(timeout=5), ['other-0', 'other-1', 'other-2',
+                                                   'other-3', 'other-4'])
+        # the worker survived.
+        self.assertEqual(batcher.predict('good', topk=1), ['good-0'])
+
+    def test_output_mismatch_fails_futures(self):
+        retriever = FakeRetriever(drop_output=True)
+        batcher = MicroBatcher(retriever.predict_batch,
+                               max_batch_size=2, max_wait_ms=200)
+        futures = [batcher.submit('a'), batcher.submit('b')]
+        for future in futures:
+            with self.assertRaises(ValueError):
+                future.result(timeout=5)
+        retriever.drop_output = False
+        self.assertEqual(batcher.predict('c', topk=1), ['c-0'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -67,9 +67,11 @@ class FS(metaclass=ABCMeta):
                                   PUB_MED=os.path.join(MODEL_DIR, 'pubmed_pmc_470k'))
 
     # Embedding files.
-    __Embedding = namedtuple('__Embedding', ['BERT_FFN_PKL', 'BERT_FFN_ZIP', 'BERT_FFN_GPT2'])
+    __Embedding = namedtuple('__Embedding', ['BERT_FFN_PKL', 'BERT_FFN_ZIP', 'BERT_FFN_STORE', 'BERT_FFN_INDEX', 'BERT_FFN_GPT2'])
     EMBEDDINGS = __Embedding(BERT_FFN_PKL=os.path.join(EMBEDDING_DIR, 'bertffn_crossentropy.pkl'),
                              BERT_FFN_ZIP=os.path.join(EMBEDDING_DIR, 'bertffn_crossentropy.zip'),
+                             BERT_FFN_STORE=os.path.join(EMBEDDING_DIR, 'bertffn_crossentropy_store'),
+                             BERT_FFN_INDEX=os.path.join(EMBEDDING_DIR, 'bertffn_crossentropy_index'),
                              BERT_FFN_GPT2=os.path.join(DATA_DIR, 'bertffn_crossentropy_gpt2_train_data.zip'))
 
 ################################################################################################
@@ -88,7 +90,7 @@ class DOWNLOADS(metaclass=ABCMeta):
 
     # Google Drive File Ids.
     __FileId = namedtuple('__FileId', ['FFN_DATA', 'FFN_INDEX', 'FFN_CKPT',
-                                       'BERT_FFN_DATA', 'BERT_FFN_INDEX', 'BERT_FNN_CKPT',
+                                       'BERT_FFN_DATA', 'BERT_FFN_INDEX', 'BERT_FFN_CKPT',
                                        'FLOAT16_EMBED', 'FLOAT16_EMBED_EXPAND'])
     FILE_ID = __FileId(
         # FFN checkpoint files.
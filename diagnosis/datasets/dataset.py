@@ -16,7 +16,10 @@
      Copyright (c) 2019. Victor I. Afolabi. All rights reserved.
 """
 
+import inspect
 import os
+import time
+import multiprocessing
 from glob import glob
 from tqdm import tqdm
 
@@ -28,15 +31,25 @@ from sklearn.model_selection import train_test_split
 __all__ = [
     'create_generator_for_ffn', 'ffn_serialize_fn', 'make_tfrecord',
     'convert_single_example', 'convert_examples_to_features',
-    'convert_text_to_feature',
+    'convert_text_to_feature', 'convert_ids_to_features',
+    'convert_texts_to_features', 'FeatureBuffer',
     'create_dataset_for_ffn', 'create_dataset_for_bert',
-    'create_generator_for_bert', 'bert_serialize_fn',
+    'create_generator_for_bert', 'bert_serialize_fn', 'make_bert_tfrecord',
     'PaddingInputExample', 'InputExample',
+    'time_input_pipeline', 'InputPipelineReport',
 ]
 
 
 SEED = 42
 
+# Word cache of each `make_bert_tfrecord` worker's tokenizer.
+TFRECORD_TOKENIZER_CACHE_SIZE = 100000
+
+# `make_bert_tfrecord` shards, named apart from the per csv files of
+# `make_tfrecord` ('{csv name}_{suffix}_{mode}.tfrecord').
+BERT_SHARD_FORMAT = '{suffix}-shard_{mode}-{index:05d}-of-{num_shards:05d}.tfrecord'
+BERT_SHARD_PATTERN = '{suffix}-shard_{mode}-*-of-*.tfrecord'
+
 
 def _float_list_feature(value):
     """Returns a float_list from a float / double."""
@@ -122,13 +135,37 @@ def make_tfrecord(data_dir, generator_fn, serialize_fn, suffix='', **kwargs):
                 writer.write(example)
 
 
+# `interleave(deterministic=...)` is TF >= 2.2, older parallel interleaves
+# always keep the order.
+_INTERLEAVE_DETERMINISTIC = 'deterministic' in inspect.signature(
+    tf.data.Dataset.interleave).parameters
+
+
+def _interleave_tfrecords(tfrecord_file_list, shuffle=False):
+    """Records of all files, read `AUTOTUNE` files at a time."""
+    files = tf.data.Dataset.from_tensor_slices(tfrecord_file_list)
+    if shuffle:
+        files = files.shuffle(len(tfrecord_file_list))
+    kwargs = {}
+    if _INTERLEAVE_DETERMINISTIC:
+        kwargs['deterministic'] = not shuffle
+    return files.interleave(
+        tf.data.TFRecordDataset,
+        num_parallel_calls=tf.data.experimental.AUTOTUNE, **kwargs)
+
+
 def create_dataset_for_ffn(
         data_dir,
         mode='train',
         hidden_size=768,
         shuffle_buffer=10000,
         prefetch=10000,
-        batch_size=32):
+        batch_size=32,
+        batch_first=False):
+    """`batch_first` batches serialized records before parsing: files are
+    interleaved, each batch is parsed by one `parse_example` call in
+    parallel, and `AUTOTUNE` batches are prefetched instead of `prefetch`
+    examples."""
 
     tfrecord_file_list = glob(os.path.join(
         data_dir, '*_FFN_{0}.tfrecord'.format((mode))))
@@ -137,13 +174,29 @@ def create_dataset_for_ffn(
         make_tfrecord(data_dir, create_generator_for_ffn,
                       ffn_serialize_fn, 'FFN')
 
+    feature_description = {
+        'features': tf.io.FixedLenFeature([2*768], tf.float32),
+        'labels': tf.io.FixedLenFeature([], tf.int64, default_value=0),
+    }
+
+    if batch_first:
+        dataset = _interleave_tfrecords(
+            tfrecord_file_list, shuffle=mode == 'train')
+        if mode == 'train':
+            dataset = dataset.shuffle(shuffle_buffer)
+        dataset = dataset.batch(batch_size)
+
+        def _parse_ffn_batch(example_protos):
+            feature_dict = tf.io.parse_example(example_protos,
+                                               feature_description)
+            return tf.reshape(feature_dict['features'], (-1, 2, 768)), feature_dict['labels']
+        dataset = dataset.map(
+            _parse_ffn_batch, num_parallel_calls=tf.data.experimental.AUTOTUNE)
+        return dataset.prefetch(tf.data.experimental.AUTOTUNE)
+
     dataset = tf.data.TFRecordDataset(tfrecord_file_list)
 
     def _parse_ffn_example(example_proto):
-        feature_description = {
-            'features': tf.io.FixedLenFeature([2*768], tf.float32),
-            'labels': tf.io.FixedLenFeature([], tf.int64, default_value=0),
-        }
         feature_dict = tf.io.parse_single_example(example_proto,
                                                   feature_description)
         return tf.reshape(feature_dict['features'], (2, 768)), feature_dict['labels']
@@ -233,22 +286,90 @@ def convert_single_example(tokenizer, example, max_seq_length=256, dynamic_paddi
     return input_ids, input_mask, segment_ids, example.label
 
 
+class FeatureBuffer(object):
+    """Reusable int32 storage for `convert_ids_to_features`.
+
+    Grows to the largest batch seen. Features written into it are views,
+    valid until the buffer is used again.
+    """
+
+    def __init__(self, size=0):
+        self._allocate(size)
+
+    def _allocate(self, size):
+        self.input_ids = np.zeros(size, dtype=np.int32)
+        self.input_masks = np.zeros(size, dtype=np.int32)
+        # single sequence inputs, segment ids are never written.
+        self.segment_ids = np.zeros(size, dtype=np.int32)
+
+    def get(self, batch_size, length):
+        """C-contiguous [batch_size, length] views of ids, masks and segment ids."""
+        size = batch_size * length
+        if size > len(self.input_ids):
+            self._allocate(size)
+        return tuple(array[:size].reshape(batch_size, length) for array in
+                     (self.input_ids, self.input_masks, self.segment_ids))
+
+
+def convert_ids_to_features(tokenizer, token_ids, max_seq_length=256,
+                            dynamic_padding=False, round_length=None, buffer=None):
+    """Input ids, masks and segment ids of a batch of `tokenizer.encode` outputs.
+
+    Each row is [CLS] ids [SEP], truncated to `max_seq_length` and
+    zero-padded to it, or with `dynamic_padding` to the longest row in the
+    batch rounded up by `round_length`. The rows are written straight into
+    int32 [n, length] arrays, views into `buffer` if one is given.
+    """
+    lengths = np.fromiter(
+        (min(len(ids), max_seq_length - 2) + 2 for ids in token_ids),
+        dtype=np.int32, count=len(token_ids))
+    length = max_seq_length
+    if dynamic_padding:
+        length = int(lengths.max(initial=2))
+        if round_length is not None:
+            length = round_length(length)
+    if buffer is None:
+        buffer = FeatureBuffer(len(token_ids) * length)
+    input_ids, input_masks, segment_ids = buffer.get(len(token_ids), length)
+
+    input_ids.fill(0)
+    input_ids[:, 0] = tokenizer.vocab["[CLS]"]
+    for row, (ids, end) in enumerate(zip(token_ids, lengths)):
+        input_ids[row, 1:end - 1] = ids[:end - 2]
+    input_ids[np.arange(len(token_ids)), lengths - 1] = tokenizer.vocab["[SEP]"]
+    # The mask has 1 for real tokens and 0 for padding tokens.
+    np.less(np.arange(length), lengths[:, np.newaxis], out=input_masks)
+    return input_ids, input_masks, segment_ids
+
+
+def convert_texts_to_features(tokenizer, texts, max_seq_length=256,
+                              dynamic_padding=False, round_length=None, buffer=None):
+    """`convert_ids_to_features` of raw `texts`."""
+    return convert_ids_to_features(
+        tokenizer, tokenizer.encode_batch(texts), max_seq_length,
+        dynamic_padding=dynamic_padding, round_length=round_length, buffer=buffer)
+
+
 def convert_examples_to_features(tokenizer, examples, max_seq_length=256, dynamic_padding=False):
     """Convert a set of `InputExample`s to a list of `InputFeatures`."""
 
-    input_ids, input_masks, segment_ids, labels = [], [], [], []
-    for example in examples:
-        input_id, input_mask, segment_id, label = convert_single_example(
-            tokenizer, example, max_seq_length, dynamic_padding=dynamic_padding
-        )
-        input_ids.append(input_id)
-        input_masks.append(input_mask)
-        segment_ids.append(segment_id)
-        labels.append(label)
+    empty = np.zeros(0, dtype=np.int32)
+    token_ids = [empty if isinstance(example, PaddingInputExample)
+                 else tokenizer.encode(example.text_a) for example in examples]
+    input_ids, input_masks, segment_ids = convert_ids_to_features(
+        tokenizer, token_ids, max_seq_length, dynamic_padding=dynamic_padding)
+    labels = []
+    for row, example in enumerate(examples):
+        if isinstance(example, PaddingInputExample):
+            input_ids[row] = 0
+            input_masks[row] = 0
+            labels.append(0)
+        else:
+            labels.append(example.label)
     return (
-        np.squeeze(np.array(input_ids)),
-        np.squeeze(np.array(input_masks)),
-        np.squeeze(np.array(segment_ids)),
+        np.squeeze(input_ids),
+        np.squeeze(input_masks),
+        np.squeeze(segment_ids),
         np.array(labels).reshape(-1, 1),
     )
 
@@ -262,6 +383,16 @@ def convert_text_to_feature(text, tokenizer, max_seq_length, dynamic_padding=Fal
     return features
 
 
+def _read_qa_csv(full_file_path):
+    if os.path.basename(full_file_path) == 'healthtap_data_cleaned.csv':
+        df = pd.read_csv(full_file_path, lineterminator='\n')
+        df.columns = ['index', 'question', 'answer']
+        df.drop(columns=['index'], inplace=True)
+    else:
+        df = pd.read_csv(full_file_path, lineterminator='\n')
+    return df
+
+
 def create_generator_for_bert(
         file_list,
         tokenizer,
@@ -274,12 +405,7 @@ def create_generator_for_bert(
         if not os.path.exists(full_file_path):
             raise FileNotFoundError("File %s not found" % full_file_path)
 
-        if os.path.basename(full_file_path) == 'healthtap_data_cleaned.csv':
-            df = pd.read_csv(full_file_path, lineterminator='\n')
-            df.columns = ['index', 'question', 'answer']
-            df.drop(columns=['index'], inplace=True)
-        else:
-            df = pd.read_csv(full_file_path, lineterminator='\n')
+        df = _read_qa_csv(full_file_path)
 
         # so train test split
         if mode == 'train':
@@ -337,6 +463,106 @@ def bert_serialize_fn(features):
     return example_proto.SerializeToString()
 
 
+# `FullTokenizer` of a `make_bert_tfrecord` worker process.
+_worker_tokenizer = None
+
+
+def _init_tfrecord_worker(tokenizer):
+    global _worker_tokenizer
+    _worker_tokenizer = tokenizer
+    # this process only tokenizes, so the cache is worth enabling.
+    if not _worker_tokenizer.cache_size:
+        _worker_tokenizer.cache_size = TFRECORD_TOKENIZER_CACHE_SIZE
+
+
+def _write_bert_shard(args):
+    path, questions, answers, max_seq_length, dynamic_padding = args
+    tokenizer = _worker_tokenizer
+    count = 0
+    with tf.io.TFRecordWriter(path + '.tmp') as writer:
+        for question, answer in zip(questions, answers):
+            try:
+                token_ids = tokenizer.encode_batch([question, answer])
+            except (ValueError, AttributeError):
+                continue
+            # both towers padded to `max_seq_length`, then cut back to each
+            # row's own length for dynamic padding.
+            input_ids, input_masks, segment_ids = convert_ids_to_features(
+                tokenizer, token_ids, max_seq_length)
+            features = []
+            for row, ids in enumerate(token_ids):
+                length = min(len(ids), max_seq_length - 2) + 2 \
+                    if dynamic_padding else max_seq_length
+                features += [input_ids[row, :length], input_masks[row, :length],
+                             segment_ids[row, :length]]
+            writer.write(bert_serialize_fn((features, 1)))
+            count += 1
+    os.replace(path + '.tmp', path)
+    return path, count
+
+
+def make_bert_tfrecord(data_dir, tokenizer, suffix='BertFFN', num_shards=None,
+                       num_workers=None, max_seq_length=256, dynamic_padding=False,
+                       test_size=0.2):
+    """Parallel `make_tfrecord` for `create_generator_for_bert`.
+
+    Every csv file in `data_dir` is read once and split into train and eval
+    rows with the same `train_test_split` as `create_generator_for_bert`.
+    The rows of each split, over all files, are dealt round-robin into
+    `num_shards` shards written to `BERT_SHARD_FORMAT`, each to a `.tmp`
+    file first and renamed when complete. `num_workers` processes
+    tokenize, serialize and write one shard at a time, largest first.
+    The shards hold the same records as the `make_tfrecord` files, dealt
+    across shards.
+
+    Arguments:
+        data_dir {str} -- dir that has csv files and stores the tf records
+        tokenizer {FullTokenizer} -- Copied to every worker
+
+    Keyword Arguments:
+        suffix {str} -- suffix of the tf record files (default: {'BertFFN'})
+        num_shards {int} -- shards per split (default: {cpu count})
+        num_workers {int} -- worker processes (default: {cpu count})
+        max_seq_length {int} -- (default: {256})
+        dynamic_padding {bool} -- write unpadded rows (default: {False})
+        test_size {float} -- fraction of each file in eval (default: {0.2})
+
+    Returns:
+        {dict} -- 'train' and 'eval' shard paths
+    """
+    num_workers = num_workers or multiprocessing.cpu_count()
+    num_shards = num_shards or multiprocessing.cpu_count()
+
+    splits = {'train': ([], []), 'eval': ([], [])}
+    for full_file_path in glob(os.path.join(data_dir, '*.csv')):
+        print('Reading file {0}'.format(full_file_path))
+        df = _read_qa_csv(full_file_path)
+        for mode, split in zip(('train', 'eval'), train_test_split(
+                df, test_size=test_size, random_state=SEED)):
+            splits[mode][0].extend(split.question.tolist())
+            splits[mode][1].extend(split.answer.tolist())
+
+    tasks, shard_files = [], {}
+    for mode, (questions, answers) in splits.items():
+        shard_files[mode] = [os.path.join(data_dir, BERT_SHARD_FORMAT.format(
+            suffix=suffix, mode=mode, index=i, num_shards=num_shards))
+            for i in range(num_shards)]
+        for i, path in enumerate(shard_files[mode]):
+            tasks.append((path, questions[i::num_shards], answers[i::num_shards],
+                          max_seq_length, dynamic_padding))
+    tasks.sort(key=lambda task: len(task[1]), reverse=True)
+
+    # spawn, not fork: the parent's TF threads don't survive a fork.
+    context = multiprocessing.get_context('spawn')
+    with context.Pool(num_workers, initializer=_init_tfrecord_worker,
+                      initargs=(tokenizer,)) as pool:
+        num_examples = sum(count for _, count in tqdm(
+            pool.imap_unordered(_write_bert_shard, tasks),
+            total=len(tasks), desc='Writing to TFRecord'))
+    print('Wrote {0} examples to {1} shards'.format(num_examples, len(tasks)))
+    return shard_files
+
+
 def create_dataset_for_bert(
         data_dir,
         tokenizer=None,
@@ -348,32 +574,70 @@ def create_dataset_for_bert(
         dynamic_padding=False,
         bucket_batch_sizes=[32, 16, 8],
         bucket_boundaries=[64, 128],
-        element_length_func=_qa_ele_to_length):
+        element_length_func=_qa_ele_to_length,
+        batch_first=False,
+        shuffle=True):
+    """`batch_first` batches serialized records before parsing: shards are
+    interleaved, each batch is parsed by one `parse_example` call in
+    parallel, and `AUTOTUNE` batches are prefetched instead of `prefetch`
+    examples. Batches can't be bucketed by length then, so with
+    `dynamic_padding` each one is padded to its own longest row.
+
+    'train' records are shuffled unless `shuffle` is False.
+    """
+    shuffle = shuffle and mode == 'train'
 
-    tfrecord_file_list = glob(os.path.join(
-        data_dir, '*_BertFFN_{0}.tfrecord'.format((mode))))
+    # `make_bert_tfrecord` shards, else the per csv files of `make_tfrecord`;
+    # never both, they hold the same records.
+    tfrecord_file_list = sorted(glob(os.path.join(
+        data_dir, BERT_SHARD_PATTERN.format(suffix='BertFFN', mode=mode))))
+    if not tfrecord_file_list:
+        tfrecord_file_list = sorted(glob(os.path.join(
+            data_dir, '*_BertFFN_{0}.tfrecord'.format((mode)))))
     if not tfrecord_file_list:
         print('TF Record not found')
-        make_tfrecord(data_dir, create_generator_for_bert,
-                      bert_serialize_fn, 'BertFFN',
-                      tokenizer=tokenizer,
-                      dynamic_padding=True,
-                      max_seq_length=max_seq_length)
-        tfrecord_file_list = glob(os.path.join(
-            data_dir, '*_BertFFN_{0}.tfrecord'.format((mode))))
+        tfrecord_file_list = make_bert_tfrecord(
+            data_dir, tokenizer, 'BertFFN',
+            dynamic_padding=True,
+            max_seq_length=max_seq_length)[mode]
+
+    feature_description = {
+        'q_input_ids': tf.io.VarLenFeature(tf.int64),
+        'q_input_masks': tf.io.VarLenFeature(tf.int64),
+        'q_segment_ids': tf.io.VarLenFeature(tf.int64),
+        'a_input_ids': tf.io.VarLenFeature(tf.int64),
+        'a_input_masks': tf.io.VarLenFeature(tf.int64),
+        'a_segment_ids': tf.io.VarLenFeature(tf.int64),
+        'labels': tf.io.FixedLenFeature([], tf.int64, default_value=0),
+    }
+
+    if batch_first:
+        dataset = _interleave_tfrecords(
+            tfrecord_file_list, shuffle=shuffle)
+        if shuffle:
+            dataset = dataset.shuffle(shuffle_buffer)
+        dataset = dataset.batch(batch_size)
+
+        def _parse_bert_batch(example_protos):
+            feature_dict = tf.io.parse_example(
+                example_protos, feature_description)
+            dense_feature_dict = {}
+            for k, v in feature_dict.items():
+                if k == 'labels':
+                    continue
+                v = tf.sparse.to_dense(v)
+                if not dynamic_padding:
+                    v = tf.pad(v, [[0, 0], [0, max_seq_length - tf.shape(v)[1]]])
+                dense_feature_dict[k] = v
+            dense_feature_dict['labels'] = feature_dict['labels']
+            return dense_feature_dict, feature_dict['labels']
+        dataset = dataset.map(
+            _parse_bert_batch, num_parallel_calls=tf.data.experimental.AUTOTUNE)
+        return dataset.prefetch(tf.data.experimental.AUTOTUNE)
 
     dataset = tf.data.TFRecordDataset(tfrecord_file_list)
 
     def _parse_bert_example(example_proto):
-        feature_description = {
-            'q_input_ids': tf.io.VarLenFeature(tf.int64),
-            'q_input_masks': tf.io.VarLenFeature(tf.int64),
-            'q_segment_ids': tf.io.VarLenFeature(tf.int64),
-            'a_input_ids': tf.io.VarLenFeature(tf.int64),
-            'a_input_masks': tf.io.VarLenFeature(tf.int64),
-            'a_segment_ids': tf.io.VarLenFeature(tf.int64),
-            'labels': tf.io.FixedLenFeature([], tf.int64, default_value=0),
-        }
         feature_dict = tf.io.parse_single_example(
             example_proto, feature_description)
         dense_feature_dict = {k: tf.sparse.to_dense(
@@ -382,7 +646,7 @@ def create_dataset_for_bert(
         return dense_feature_dict, feature_dict['labels']
     dataset = dataset.map(_parse_bert_example)
 
-    if mode == 'train':
+    if shuffle:
         dataset = dataset.shuffle(shuffle_buffer)
     if dynamic_padding:
         dataset = dataset.apply(
@@ -397,3 +661,99 @@ def create_dataset_for_bert(
     dataset = dataset.prefetch(prefetch)
 
     return dataset
+
+
+def _batch_reader(dataset):
+    """(reset, next_batch, end_errors) reading `dataset` from its start.
+
+    In graph mode the iterator ops are built here once, `reset` only
+    re-runs their initializer in the Keras session.
+    """
+    if tf.executing_eagerly():
+        state = {}
+
+        def reset():
+            state['iterator'] = iter(dataset)
+        next_batch = lambda: next(state['iterator'])  # noqa: E731
+        return reset, next_batch, (StopIteration, tf.errors.OutOfRangeError)
+
+    iterator = tf.compat.v1.data.make_initializable_iterator(dataset)
+    get_next = iterator.get_next()
+    session = tf.compat.v1.keras.backend.get_session()
+    reset = lambda: session.run(iterator.initializer)  # noqa: E731
+    next_batch = lambda: session.run(get_next)  # noqa: E731
+    return reset, next_batch, (tf.errors.OutOfRangeError,)
+
+
+def _time_batches(reader, num_batches):
+    reset, next_batch, end_errors = reader
+    reset()
+    try:
+        next_batch()
+    except end_errors:
+        return float('nan')
+    count = 0
+    start = time.monotonic()
+    try:
+        for count in range(1, num_batches + 1):
+            next_batch()
+    except end_errors:
+        count -= 1
+    return (time.monotonic() - start) / max(count, 1)
+
+
+def time_input_pipeline(dataset, num_batches=100):
+    """Seconds per batch of iterating `dataset` alone, after one warm-up batch.
+
+    Works in eager and in graph mode, where batches are fetched with the
+    Keras session.
+    """
+    return _time_batches(_batch_reader(dataset), num_batches)
+
+
+class InputPipelineReport(tf.keras.callbacks.Callback):
+    """Prints whether training is input bound after every epoch.
+
+    The mean wall time of a train step, input wait included, is compared
+    with `time_input_pipeline` of `dataset`. With prefetching a step takes
+    about max(input, compute): if producing a batch alone takes
+    `threshold` of a step or more, the model waits for input.
+
+    The iterator over `dataset` is built once and restarted every epoch.
+    Pass an unshuffled view of the training data (`shuffle=False`), so
+    timing doesn't refill a large shuffle buffer each time.
+
+    Arguments:
+        dataset (tf.data.Dataset): The training dataset, unshuffled.
+        num_batches (int): Batches read to time the input pipeline.
+        threshold (float): Input / step time ratio reported as input bound.
+    """
+
+    def __init__(self, dataset, num_batches=50, threshold=0.9):
+        super(InputPipelineReport, self).__init__()
+        self.dataset = dataset
+        self.num_batches = num_batches
+        self.threshold = threshold
+
+    def on_train_begin(self, logs=None):
+        self.reader = _batch_reader(self.dataset)
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self.step_times = []
+
+    def on_train_batch_begin(self, batch, logs=None):
+        self.step_start = time.monotonic()
+
+    def on_train_batch_end(self, batch, logs=None):
+        self.step_times.append(time.monotonic() - self.step_start)
+
+    def on_epoch_end(self, epoch, logs=None):
+        # the first step also builds or traces the model.
+        step_times = self.step_times[1:] or self.step_times
+        if not step_times:
+            return
+        step_time = float(np.mean(step_times))
+        input_time = _time_batches(self.reader, self.num_batches)
+        bound = 'input' if input_time >= self.threshold * step_time else 'compute'
+        print('Epoch {0}: train step {1:.1f}ms, input pipeline {2:.1f}ms per batch: {3} bound'.format(
+            epoch + 1, step_time * 1000, input_time * 1000, bound))
@@ -21,8 +21,10 @@ from __future__ import print_function
 import re
 import six
 import collections
+import threading
 import unicodedata
 
+import numpy as np
 import tensorflow as tf
 
 
@@ -35,6 +37,19 @@ __all__ = [
 ]
 
 
+# Key of the token ending at a `WordpieceTokenizer` trie node, never a char.
+_TRIE_END = ""
+
+# `BasicTokenizer._clean_text` for pure ASCII text: tab, newline and carriage
+# return become spaces, the other control characters are dropped.
+_ASCII_CLEAN_TABLE = {cp: None for cp in list(range(32)) + [127]}
+_ASCII_CLEAN_TABLE.update({ord(char): " " for char in "\t\n\r"})
+
+# `BasicTokenizer._run_split_on_punc` for an ASCII word: every non-letter,
+# non-number ASCII char is a token of its own.
+_ASCII_PUNC_RE = re.compile(r"[!-/:-@\[-`{-~]|[^!-/:-@\[-`{-~]+")
+
+
 def validate_case_matches_checkpoint(do_lower_case, init_checkpoint):
     """Checks whether the casing config is consistent with the checkpoint name."""
 
@@ -169,15 +184,65 @@ def whitespace_tokenize(text):
 
 
 class FullTokenizer(object):
-    """Runs end-to-end tokenziation."""
+    """Runs end-to-end tokenziation.
+
+    With `cache_size` > 0 the word pieces and ids of the last `cache_size`
+    distinct words are kept in an LRU cache, so a repeated word skips basic
+    and WordPiece tokenization. `cache_hits` and `cache_misses` count
+    lookups. Threads can share a tokenizer, cache updates take a lock.
+    """
 
-    def __init__(self, vocab_file, do_lower_case=True):
+    def __init__(self, vocab_file, do_lower_case=True, cache_size=0):
         self.vocab = load_vocab(vocab_file)
         self.inv_vocab = {v: k for k, v in self.vocab.items()}
         self.basic_tokenizer = BasicTokenizer(do_lower_case=do_lower_case)
         self.wordpiece_tokenizer = WordpieceTokenizer(vocab=self.vocab)
+        self.cache_size = cache_size
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self._cache = collections.OrderedDict()
+        self._cache_lock = threading.Lock()
+
+    def __getstate__(self):
+        # locks don't pickle, a copy starts with an empty cache and its own lock.
+        state = self.__dict__.copy()
+        del state['_cache_lock']
+        state['_cache'] = collections.OrderedDict()
+        state['cache_hits'] = state['cache_misses'] = 0
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._cache_lock = threading.Lock()
+
+    def _word_pieces(self, word):
+        """(word pieces, ids) of a whitespace-free `word`, through the cache."""
+        cache = self._cache
+        with self._cache_lock:
+            entry = cache.get(word)
+            if entry is not None:
+                self.cache_hits += 1
+                cache.move_to_end(word)
+                return entry
+            self.cache_misses += 1
+        # tokenized outside the lock, racing threads store equal entries.
+        pieces = [sub_token
+                  for token in self.basic_tokenizer.tokenize_word(word)
+                  for sub_token in self.wordpiece_tokenizer.tokenize_word(token)]
+        entry = pieces, [self.vocab[piece] for piece in pieces]
+        with self._cache_lock:
+            cache[word] = entry
+            if len(cache) > self.cache_size:
+                cache.popitem(last=False)
+        return entry
 
     def tokenize(self, text):
+        if self.cache_size > 0:
+            split_tokens = []
+            for word in self.basic_tokenizer.split_words(text):
+                split_tokens.extend(self._word_pieces(word)[0])
+            return split_tokens
+
         split_tokens = []
         for token in self.basic_tokenizer.tokenize(text):
             for sub_token in self.wordpiece_tokenizer.tokenize(token):
@@ -185,6 +250,35 @@ class FullTokenizer(object):
 
         return split_tokens
 
+    def cache_info(self):
+        """Hits, misses and current size of the word cache."""
+        return {'hits': self.cache_hits, 'misses': self.cache_misses,
+                'size': len(self._cache), 'max_size': self.cache_size}
+
+    def clear_cache(self):
+        with self._cache_lock:
+            self._cache.clear()
+            self.cache_hits = self.cache_misses = 0
+
+    def tokenize_batch(self, texts):
+        """`tokenize` for every text in `texts`."""
+        return [self.tokenize(text) for text in texts]
+
+    def encode(self, text):
+        """Word piece ids of `text` as an int32 array, no [CLS]/[SEP]."""
+        if self.cache_size > 0:
+            ids = []
+            for word in self.basic_tokenizer.split_words(text):
+                ids.extend(self._word_pieces(word)[1])
+            return np.array(ids, dtype=np.int32)
+        vocab = self.vocab
+        return np.array([vocab[token] for token in self.tokenize(text)],
+                        dtype=np.int32)
+
+    def encode_batch(self, texts):
+        """`encode` for every text in `texts`, a list of int32 arrays."""
+        return [self.encode(text) for text in texts]
+
     def convert_tokens_to_ids(self, tokens):
         return convert_by_vocab(self.vocab, tokens)
 
@@ -204,7 +298,18 @@ class BasicTokenizer(object):
 
     def tokenize(self, text):
         """Tokenizes a piece of text."""
+        output_tokens = []
+        for word in self.split_words(text):
+            output_tokens.extend(self.tokenize_word(word))
+        return output_tokens
+
+    def split_words(self, text):
+        """Cleans `text` and splits it on whitespace, before lower casing
+        and punctuation splitting."""
         text = convert_to_unicode(text)
+        if text.isascii():
+            # No unicode whitespace, control or CJK characters to look for.
+            return text.translate(_ASCII_CLEAN_TABLE).split()
         text = self._clean_text(text)
 
         # This was added on November 1st, 2018 for the multilingual and Chinese
@@ -215,16 +320,20 @@ class BasicTokenizer(object):
         # words in the English Wikipedia.).
         text = self._tokenize_chinese_chars(text)
 
-        orig_tokens = whitespace_tokenize(text)
-        split_tokens = []
-        for token in orig_tokens:
+        return whitespace_tokenize(text)
+
+    def tokenize_word(self, token):
+        """Lower cases, strips accents and splits punctuation of a single
+        word from `split_words`."""
+        if token.isascii():
+            # ASCII has no accents, and its punctuation is a fixed set.
             if self.do_lower_case:
                 token = token.lower()
-                token = self._run_strip_accents(token)
-            split_tokens.extend(self._run_split_on_punc(token))
-
-        output_tokens = whitespace_tokenize(" ".join(split_tokens))
-        return output_tokens
+            return _ASCII_PUNC_RE.findall(token)
+        if self.do_lower_case:
+            token = token.lower()
+            token = self._run_strip_accents(token)
+        return whitespace_tokenize(" ".join(self._run_split_on_punc(token)))
 
     def _run_strip_accents(self, text):
         """Strips accents from a piece of text."""
@@ -313,6 +422,25 @@ class WordpieceTokenizer(object):
         self.vocab = vocab
         self.unk_token = unk_token
         self.max_input_chars_per_word = max_input_chars_per_word
+        # Prefix tries over the vocab: `_trie` for pieces at the start of a
+        # word, `_suffix_trie` for "##" continuations (without the "##").
+        # Each node maps a char to its child, `_TRIE_END` holds the token
+        # ending at that node.
+        self._trie = {}
+        self._suffix_trie = {}
+        for token in vocab:
+            self._insert(self._trie, token, token)
+            if token.startswith("##") and len(token) > 2:
+                self._insert(self._suffix_trie, token[2:], token)
+
+    @staticmethod
+    def _insert(trie, chars, token):
+        if not chars:
+            return
+        node = trie
+        for char in chars:
+            node = node.setdefault(char, {})
+        node[_TRIE_END] = token
 
     def tokenize(self, text):
         """Tokenizes a piece of text into its word pieces.
@@ -332,36 +460,37 @@ class WordpieceTokenizer(object):
 
         output_tokens = []
         for token in whitespace_tokenize(text):
-            chars = list(token)
-            if len(chars) > self.max_input_chars_per_word:
-                output_tokens.append(self.unk_token)
-                continue
+            output_tokens.extend(self.tokenize_word(token))
+        return output_tokens
 
-            is_bad = False
-            start = 0
-            sub_tokens = []
-            while start < len(chars):
-                end = len(chars)
-                cur_substr = None
-                while start < end:
-                    substr = "".join(chars[start:end])
-                    if start > 0:
-                        substr = "##" + substr
-                    if substr in self.vocab:
-                        cur_substr = substr
-                        break
-                    end -= 1
-                if cur_substr is None:
-                    is_bad = True
-                    break
-                sub_tokens.append(cur_substr)
-                start = end
+    def tokenize_word(self, token):
+        """Word pieces of a single whitespace-free `token`.
 
-            if is_bad:
-                output_tokens.append(self.unk_token)
-            else:
-                output_tokens.extend(sub_tokens)
-        return output_tokens
+        Walks the trie forward from each piece start and keeps the last
+        token seen, i.e. the longest vocab match, instead of testing every
+        shorter substring against the vocab.
+        """
+        if len(token) > self.max_input_chars_per_word:
+            return [self.unk_token]
+
+        start = 0
+        trie = self._trie
+        sub_tokens = []
+        while start < len(token):
+            node = trie
+            cur_substr = None
+            for i in range(start, len(token)):
+                node = node.get(token[i])
+                if node is None:
+                    break
+                if _TRIE_END in node:
+                    cur_substr, end = node[_TRIE_END], i + 1
+            if cur_substr is None:
+                return [self.unk_token]
+            sub_tokens.append(cur_substr)
+            start = end
+            trie = self._suffix_trie
+        return sub_tokens
 
 
 def _is_whitespace(char):
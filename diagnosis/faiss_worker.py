@@ -0,0 +1,74 @@
+"""Worker process of `diagnosis.models.docproduct.faiss_index.ShardedIndex`.
+
+   Lives outside `diagnosis.models`: spawned workers import the module of
+   their target, and the `diagnosis.models` package imports TensorFlow and
+   the BERT/GPT-2 models. This module only needs faiss.
+
+   @project
+     File: faiss_worker.py
+     Package: diagnosis
+
+   @license
+     BSD-3 Clause license.
+     Copyright (c) 2019. Victor I. Afolabi. All rights reserved.
+"""
+import faiss
+
+
+# IO_FLAG_MMAP_IFC maps flat codes and IVF lists alike; older faiss only
+# has IO_FLAG_MMAP, which copies flat codes to the heap. Don't combine
+# them, IVF indexes refuse to load with both.
+MMAP_FLAGS = getattr(faiss, 'IO_FLAG_MMAP_IFC', faiss.IO_FLAG_MMAP)
+
+
+def set_index_params(index, nprobe=None, ef_search=None):
+    """`nprobe` / `efSearch` of a FAISS index; None keeps the current value."""
+    params = faiss.ParameterSpace()
+    if nprobe is not None:
+        params.set_index_parameter(index, 'nprobe', nprobe)
+    if ef_search is not None:
+        params.set_index_parameter(index, 'efSearch', ef_search)
+    return index
+
+
+def _handle(index, method, args):
+    if method == 'search':
+        return index.search(*args)
+    if method == 'set_search_params':
+        set_index_params(index, *args)
+        return None
+    if method == 'ntotal':
+        return index.ntotal
+    raise ValueError('Unknown shard worker method: {0}'.format(method))
+
+
+def shard_worker(path, mmap, num_threads, conn):
+    """Serves one shard file over `conn` until it receives None.
+
+    Every request gets one `(ok, result)` reply; a failing request replies
+    `(False, exception)` and the worker keeps serving.
+    """
+    faiss.omp_set_num_threads(num_threads)
+    try:
+        index = faiss.read_index(path, MMAP_FLAGS if mmap else 0)
+        error = None
+    except Exception as e:
+        index, error = None, e
+    while True:
+        request = conn.recv()
+        if request is None:
+            break
+        if error is not None:
+            conn.send((False, error))
+            continue
+        method, args = request
+        try:
+            reply = (True, _handle(index, method, args))
+        except Exception as e:
+            reply = (False, e)
+        try:
+            conn.send(reply)
+        except Exception as e:
+            # an exception that doesn't pickle still reaches the parent.
+            conn.send((False, RuntimeError(repr(e if reply[0] else reply[1]))))
+    conn.close()
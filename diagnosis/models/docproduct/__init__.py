@@ -1,4 +1,4 @@
-from docproduct import loss
-from docproduct import metrics
-from docproduct import models
-from docproduct import predictor
+from . import loss
+from . import metrics
+from . import models
+from . import predictor
@@ -0,0 +1,323 @@
+import hashlib
+import json
+import os
+import shutil
+import struct
+
+import numpy as np
+import pandas as pd
+
+MAGIC = b'DPEMBED1'
+# matrices start on a 64 byte boundary after the JSON header.
+ALIGNMENT = 64
+EMBEDDING_FILE = 'embeddings.bin'
+# fingerprint and pooling of an index directory, see `write_model_info`.
+MODEL_FILE = 'model.json'
+
+
+def model_fingerprint(weight_file):
+    """Short hash identifying the weights embeddings were computed with.
+
+    For a TF checkpoint prefix only the small `.index` file is hashed, it
+    already holds a checksum of every tensor. None if nothing is found.
+    """
+    if weight_file is None:
+        return None
+    for path in (weight_file + '.index', weight_file):
+        if os.path.isfile(path):
+            sha = hashlib.sha1()
+            with open(path, 'rb') as f:
+                for chunk in iter(lambda: f.read(1 << 20), b''):
+                    sha.update(chunk)
+            return sha.hexdigest()[:16]
+    return None
+
+
+def write_text_store(store_dir, name, texts):
+    """Writes `texts` as one UTF-8 blob plus an int64 offsets array.
+
+    Row `i` is `blob[offsets[i]:offsets[i + 1]]`, see `TextStore`.
+    """
+    os.makedirs(store_dir, exist_ok=True)
+    offsets = np.zeros(len(texts) + 1, dtype=np.int64)
+    with open(os.path.join(store_dir, name + '.utf8'), 'wb') as f:
+        for i, text in enumerate(texts):
+            data = text.encode('utf8')
+            f.write(data)
+            offsets[i + 1] = offsets[i] + len(data)
+    np.save(os.path.join(store_dir, name + '.offsets.npy'), offsets)
+
+
+def append_text_store(store_dir, name, texts):
+    """Appends `texts` to a `write_text_store` store, in place.
+
+    The blob is extended before the offsets are replaced, so readers never
+    see offsets past the end of the blob.
+    """
+    offsets = np.load(os.path.join(store_dir, name + '.offsets.npy'))
+    offsets = np.concatenate(
+        [offsets, np.zeros(len(texts), dtype=np.int64)])
+    start = len(offsets) - len(texts) - 1
+    with open(os.path.join(store_dir, name + '.utf8'), 'ab') as f:
+        for i, text in enumerate(texts, start):
+            data = text.encode('utf8')
+            f.write(data)
+            offsets[i + 1] = offsets[i] + len(data)
+    path = os.path.join(store_dir, name + '.offsets.npy')
+    np.save(path + '.tmp.npy', offsets)
+    os.replace(path + '.tmp.npy', path)
+
+
+class TextStore(object):
+    """Memory-mapped texts written by `write_text_store`.
+
+    Nothing is decoded up front: indexing with an int or an array of ids
+    decodes only those rows, an array comes back as an object array of
+    the same shape. Processes opening the same files share their pages.
+    """
+
+    def __init__(self, store_dir, name):
+        super(TextStore, self).__init__()
+        self.store_dir = store_dir
+        self.name = name
+        self.offsets = np.load(
+            os.path.join(store_dir, name + '.offsets.npy'), mmap_mode='r')
+        path = os.path.join(store_dir, name + '.utf8')
+        # np.memmap can't map an empty file.
+        if self.offsets[-1]:
+            self.blob = np.memmap(path, dtype=np.uint8, mode='r')
+        else:
+            self.blob = np.zeros(0, dtype=np.uint8)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def _decode(self, i):
+        return self.blob[self.offsets[i]:self.offsets[i + 1]].tobytes().decode('utf8')
+
+    def __getitem__(self, ids):
+        if np.isscalar(ids):
+            return self._decode(ids)
+        ids = np.asarray(ids)
+        texts = np.empty(ids.size, dtype=object)
+        for j, i in enumerate(ids.ravel()):
+            texts[j] = self._decode(i)
+        return texts.reshape(ids.shape)
+
+
+class AppendedTexts(object):
+    """`base` texts (a `TextStore` or an object array) followed by `texts`.
+
+    Indexes like `TextStore`: rows of `base` are still only decoded when
+    asked for, the appended ones are kept in memory.
+    """
+
+    def __init__(self, base, texts):
+        super(AppendedTexts, self).__init__()
+        self.base = base
+        self.texts = np.array(texts, dtype=object)
+
+    def append(self, texts):
+        return AppendedTexts(self.base, np.concatenate(
+            [self.texts, np.array(texts, dtype=object)]))
+
+    def __len__(self):
+        return len(self.base) + len(self.texts)
+
+    def __getitem__(self, ids):
+        start = len(self.base)
+        if np.isscalar(ids):
+            return self.base[ids] if ids < start else self.texts[ids - start]
+        ids = np.asarray(ids)
+        texts = np.empty(ids.shape, dtype=object)
+        in_base = ids < start
+        texts[in_base] = self.base[ids[in_base]]
+        texts[~in_base] = self.texts[ids[~in_base] - start]
+        return texts
+
+
+def copy_text_store(store_dir, name, texts):
+    """Writes `texts` to `store_dir` like `write_text_store`.
+
+    Rows of a `TextStore`, also as the base of `AppendedTexts`, are copied
+    file to file without being decoded; any other texts are encoded row
+    by row.
+    """
+    if isinstance(texts, AppendedTexts):
+        copy_text_store(store_dir, name, texts.base)
+        append_text_store(store_dir, name, texts.texts)
+        return
+    if not isinstance(texts, TextStore):
+        write_text_store(store_dir, name, texts[np.arange(len(texts))])
+        return
+
+    blob = os.path.join(store_dir, name + '.utf8')
+    source = os.path.join(texts.store_dir, texts.name + '.utf8')
+    if os.path.isfile(blob) and os.path.samefile(blob, source):
+        return
+    os.makedirs(store_dir, exist_ok=True)
+    shutil.copyfile(source, blob)
+    # rows appended to the source after `texts` was opened are dropped.
+    with open(blob, 'r+b') as f:
+        f.truncate(texts.offsets[-1])
+    np.save(os.path.join(store_dir, name + '.offsets.npy'), np.asarray(texts.offsets))
+
+
+def _check_model(path, stored, expected):
+    """Raises if the stored (fingerprint, pooling) differ from `expected`.
+
+    None on either side means unknown and is not checked.
+    """
+    for what, was, now in zip(('model', 'pooling'), stored, expected):
+        if None not in (was, now) and was != now:
+            raise ValueError(
+                'Embeddings in {0} were computed with {1} {2}, not {3}. '
+                'Re-run train_data_to_embedding.'.format(path, what, was, now))
+
+
+def write_model_info(index_dir, fingerprint=None, pooling=None):
+    """Records the weights and pooling behind the indexes of `index_dir`."""
+    os.makedirs(index_dir, exist_ok=True)
+    with open(os.path.join(index_dir, MODEL_FILE), 'w') as f:
+        json.dump({'fingerprint': fingerprint, 'pooling': pooling}, f)
+
+
+def read_model_info(path):
+    """(fingerprint, pooling) of an embedding store or an index directory.
+
+    Either is None when `path` doesn't record it, e.g. a pickle/parquet file.
+    """
+    if is_embedding_store(path):
+        store = EmbeddingStore(path)
+        return store.fingerprint, store.pooling
+    if os.path.isfile(os.path.join(path, MODEL_FILE)):
+        with open(os.path.join(path, MODEL_FILE)) as f:
+            info = json.load(f)
+        return info.get('fingerprint'), info.get('pooling')
+    return None, None
+
+
+def check_model(path, fingerprint=None, pooling=None):
+    """Raises if `path` was embedded with other weights or pooling."""
+    _check_model(path, read_model_info(path), (fingerprint, pooling))
+
+
+def is_embedding_store(path):
+    return os.path.isfile(os.path.join(path, EMBEDDING_FILE))
+
+
+def write_embedding_store(store_dir, question_embeddings, answer_embeddings,
+                          questions, answers, fingerprint=None, dtype='float32',
+                          pooling=None):
+    """Writes QA embeddings and texts in the format read by `EmbeddingStore`.
+
+    `embeddings.bin` holds a magic string, the length of a JSON header
+    (dim, dtype, count, fingerprint, pooling) and the header, then the question and
+    the answer matrices as contiguous row-major `dtype` arrays. Texts go to
+    'question' and 'answer' `TextStore`s, in the same row order.
+    """
+    dtype = np.dtype(dtype)
+    question_embeddings = np.asarray(question_embeddings)
+    answer_embeddings = np.asarray(answer_embeddings)
+    assert question_embeddings.shape == answer_embeddings.shape
+    assert len(questions) == len(answers) == len(question_embeddings)
+    count, dim = question_embeddings.shape
+
+    header = json.dumps({'dim': dim, 'dtype': dtype.name, 'count': count,
+                         'fingerprint': fingerprint,
+                         'pooling': pooling}).encode('utf8')
+    offset = len(MAGIC) + 8 + len(header)
+    header += b' ' * (-offset % ALIGNMENT)
+
+    os.makedirs(store_dir, exist_ok=True)
+    with open(os.path.join(store_dir, EMBEDDING_FILE), 'wb') as f:
+        f.write(MAGIC)
+        f.write(struct.pack('<Q', len(header)))
+        f.write(header)
+        for embeddings in (question_embeddings, answer_embeddings):
+            f.write(np.ascontiguousarray(embeddings, dtype=dtype).tobytes())
+
+    write_text_store(store_dir, 'question', questions)
+    write_text_store(store_dir, 'answer', answers)
+
+
+class EmbeddingStore(object):
+    """Read side of `write_embedding_store`.
+
+    `question_embeddings` and `answer_embeddings` are read-only
+    `np.memmap`s of shape [count, dim]: opening the store copies nothing.
+    """
+
+    def __init__(self, store_dir):
+        super(EmbeddingStore, self).__init__()
+        self.store_dir = store_dir
+        path = os.path.join(store_dir, EMBEDDING_FILE)
+        with open(path, 'rb') as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError(
+                    '{0} is not an embedding store file.'.format(path))
+            header_size, = struct.unpack('<Q', f.read(8))
+            header = json.loads(f.read(header_size).decode('utf8'))
+        self.dim = header['dim']
+        self.dtype = np.dtype(header['dtype'])
+        self.count = header['count']
+        self.fingerprint = header['fingerprint']
+        # older stores don't record it.
+        self.pooling = header.get('pooling')
+
+        offset = len(MAGIC) + 8 + header_size
+        shape = (self.count, self.dim)
+        self.question_embeddings = np.memmap(
+            path, dtype=self.dtype, mode='r', offset=offset, shape=shape)
+        self.answer_embeddings = np.memmap(
+            path, dtype=self.dtype, mode='r', shape=shape,
+            offset=offset + self.count * self.dim * self.dtype.itemsize)
+
+    def check_fingerprint(self, fingerprint, pooling=None):
+        """Raises if the store was built with other weights than
+        `fingerprint` or another `pooling`."""
+        _check_model(self.store_dir, (self.fingerprint, self.pooling),
+                     (fingerprint, pooling))
+
+    def texts(self, name):
+        """'question' or 'answer' `TextStore`."""
+        return TextStore(self.store_dir, name)
+
+
+def load_embeddings(path, search_modes=('question', 'answer')):
+    """(question embeddings, answer embeddings, questions, answers) from `path`.
+
+    `path` is an embedding store directory, or a legacy pickle/parquet file
+    with `Q_FFNN_embeds`/`A_FFNN_embeds` list columns. Embeddings keep
+    float16 if stored that way, float32 otherwise. Texts index like
+    numpy arrays: lazy `TextStore`s for a store, object arrays otherwise.
+
+    Only the embeddings of `search_modes` are read, the other one is None.
+    A parquet file skips the unused column, a pickle can't.
+    """
+    columns = [(search_by, column) for search_by, column in
+               (('question', 'Q_FFNN_embeds'), ('answer', 'A_FFNN_embeds'))]
+    if is_embedding_store(path):
+        store = EmbeddingStore(path)
+        return (store.question_embeddings if 'question' in search_modes else None,
+                store.answer_embeddings if 'answer' in search_modes else None,
+                store.texts('question'), store.texts('answer'))
+
+    _, ext = os.path.splitext(path)
+    if ext == '.pkl':
+        df = pd.read_pickle(path)
+    else:
+        df = pd.read_parquet(path, columns=['question', 'answer'] + [
+            column for search_by, column in columns if search_by in search_modes])
+    embeddings = []
+    for search_by, column in columns:
+        if search_by not in search_modes:
+            embeddings.append(None)
+            continue
+        matrix = np.stack(df[column].to_numpy())
+        # half precision files (DOWNLOADS.FILE_ID.FLOAT16_EMBED) stay half.
+        if matrix.dtype != np.float16:
+            matrix = matrix.astype('float32')
+        embeddings.append(matrix)
+    return (embeddings[0], embeddings[1],
+            df.question.to_numpy(), df.answer.to_numpy())
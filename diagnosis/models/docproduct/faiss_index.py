@@ -0,0 +1,238 @@
+import glob
+import multiprocessing
+import os
+import threading
+import time
+
+import faiss
+import numpy as np
+
+from diagnosis.faiss_worker import MMAP_FLAGS, set_index_params, shard_worker
+
+
+# rows upcast to float32 at a time while adding float16 embeddings.
+ADD_BATCH_SIZE = 65536
+
+
+def _trained_index(embeddings, index_factory, train_size, seed):
+    index = faiss.index_factory(
+        embeddings.shape[-1], 'IDMap2,' + index_factory,
+        faiss.METRIC_INNER_PRODUCT)
+    if not index.is_trained:
+        rng = np.random.RandomState(seed)
+        sample = embeddings
+        if len(embeddings) > train_size:
+            sample = embeddings[np.sort(rng.choice(
+                len(embeddings), train_size, replace=False))]
+        index.train(np.ascontiguousarray(sample, dtype='float32'))
+    return index
+
+
+def _add(index, embeddings, ids):
+    for start in range(0, len(embeddings), ADD_BATCH_SIZE):
+        batch = slice(start, start + ADD_BATCH_SIZE)
+        index.add_with_ids(
+            np.ascontiguousarray(embeddings[batch], dtype='float32'), ids[batch])
+
+
+def build_index(embeddings, index_factory='Flat', train_size=100000, seed=42, ids=None):
+    """Inner-product FAISS index over `embeddings`, described by `index_factory`.
+
+    Any `faiss.index_factory` string works, e.g. 'Flat' (exact, the old
+    behaviour), 'IVF4096,Flat', 'HNSW32' or 'IVF4096,PQ64'. 'SQfp16' and
+    'SQ8' store half and a quarter of the float32 bytes. Indexes that need
+    training are trained on at most `train_size` random rows.
+
+    `embeddings` may be float16, e.g. an `EmbeddingStore` memmap: rows are
+    upcast one batch at a time, never the whole matrix.
+
+    The index is wrapped in an `IndexIDMap2`, so rows keep the `ids` they
+    were added with (row numbers by default) across `remove_ids`.
+    """
+    index = _trained_index(embeddings, index_factory, train_size, seed)
+    if ids is None:
+        ids = np.arange(len(embeddings))
+    _add(index, embeddings, np.asarray(ids, dtype='int64'))
+    return index
+
+
+def build_shards(embeddings, num_shards, index_factory='Flat', train_size=100000, seed=42):
+    """`build_index` split into `num_shards` indexes over contiguous row ranges.
+
+    All shards share one training run and keep global row ids, so their
+    results merge directly, see `ShardedIndex`.
+    """
+    trained = _trained_index(embeddings, index_factory, train_size, seed)
+    bounds = np.linspace(0, len(embeddings), num_shards + 1).astype(int)
+    shards = []
+    for start, end in zip(bounds[:-1], bounds[1:]):
+        shard = faiss.clone_index(trained)
+        _add(shard, embeddings[start:end], np.arange(start, end, dtype='int64'))
+        shards.append(shard)
+    return shards
+
+
+def set_search_params(index, nprobe=None, ef_search=None):
+    """Sets the query-time knobs of `index`; None keeps the current value.
+
+    `nprobe` is the number of IVF lists scanned per query, `ef_search` the
+    HNSW candidate list size. Both trade latency for recall.
+    """
+    if isinstance(index, ShardedIndex):
+        index.set_search_params(nprobe, ef_search)
+        return index
+    return set_index_params(index, nprobe, ef_search)
+
+
+def supports_remove(index):
+    """False for indexes whose `remove_ids` FAISS doesn't implement (HNSW)."""
+    if isinstance(index, faiss.IndexIDMap):
+        index = faiss.downcast_index(index.index)
+    return not isinstance(index, faiss.IndexHNSW)
+
+
+def index_file(index_dir, search_by):
+    """Path of the 'question' or 'answer' index written by `save_index`."""
+    return os.path.join(index_dir, '{0}.index'.format(search_by))
+
+
+def save_index(index, index_dir, search_by):
+    os.makedirs(index_dir, exist_ok=True)
+    # processes that mapped the old file keep reading it until they reload.
+    path = index_file(index_dir, search_by)
+    faiss.write_index(index, path + '.tmp')
+    os.replace(path + '.tmp', path)
+    # shards of an earlier `save_shards` would be loaded instead.
+    for shard_path in shard_files(index_dir, search_by):
+        os.remove(shard_path)
+
+
+def load_index(index_dir, search_by, mmap=True):
+    """Reads an index written by `save_index`.
+
+    With `mmap` the vectors stay in the page cache instead of the heap:
+    loading is near-instant and processes serving the same file share
+    its pages.
+    """
+    return faiss.read_index(
+        index_file(index_dir, search_by), MMAP_FLAGS if mmap else 0)
+
+
+def shard_files(index_dir, search_by):
+    """Shard files written by `save_shards`, in shard order."""
+    return sorted(glob.glob(os.path.join(
+        index_dir, '{0}.shard*.index'.format(search_by))))
+
+
+def save_shards(shards, index_dir, search_by):
+    os.makedirs(index_dir, exist_ok=True)
+    for path in shard_files(index_dir, search_by):
+        os.remove(path)
+    for i, shard in enumerate(shards):
+        faiss.write_index(shard, os.path.join(
+            index_dir, '{0}.shard{1:04d}.index'.format(search_by, i)))
+    # the unsharded index of an earlier `save_index` is stale now.
+    if os.path.isfile(index_file(index_dir, search_by)):
+        os.remove(index_file(index_dir, search_by))
+
+
+class ShardedIndex(object):
+    """Searches `save_shards` files in parallel worker processes.
+
+    Each worker memory-maps one shard, so shard pages live once in the page
+    cache however many processes read them, and scans run outside the
+    parent's GIL. `search` sends the queries to every worker and merges
+    their results into a global top k. Calls are serialized, so threads
+    can share an instance. An error in a worker is raised in the caller
+    and the worker keeps serving.
+
+    The workers run `diagnosis.faiss_worker`, which imports faiss
+    only, not TensorFlow.
+
+    Arguments:
+        paths (list): Shard files, see `shard_files`.
+        mmap (bool): Memory-map the shards instead of reading them.
+        num_threads (int): FAISS threads per worker.
+    """
+
+    def __init__(self, paths, mmap=True, num_threads=1):
+        super(ShardedIndex, self).__init__()
+        # spawn, not fork: TF and OpenMP threads don't survive a fork.
+        context = multiprocessing.get_context('spawn')
+        # one request in flight per pipe, replies would interleave otherwise.
+        self.lock = threading.Lock()
+        self.conns, self.workers = [], []
+        for path in paths:
+            conn, worker_conn = context.Pipe()
+            worker = context.Process(
+                target=shard_worker, args=(path, mmap, num_threads, worker_conn),
+                daemon=True)
+            worker.start()
+            self.conns.append(conn)
+            self.workers.append(worker)
+        try:
+            self.ntotal = sum(self._broadcast('ntotal'))
+        except Exception:
+            self.close()
+            raise
+
+    def _broadcast(self, method, *args):
+        with self.lock:
+            for conn in self.conns:
+                conn.send((method, args))
+            # every reply is read, a pipe left with one would be out of step.
+            replies = [conn.recv() for conn in self.conns]
+        for ok, result in replies:
+            if not ok:
+                raise result
+        return [result for _, result in replies]
+
+    def search(self, queries, k):
+        results = self._broadcast('search', queries, k)
+        scores = np.concatenate([r[0] for r in results], axis=1)
+        ids = np.concatenate([r[1] for r in results], axis=1)
+        # missing neighbours score -inf-ish and sort last.
+        top = np.argsort(-scores, axis=1, kind='stable')[:, :k]
+        return (np.take_along_axis(scores, top, axis=1),
+                np.take_along_axis(ids, top, axis=1))
+
+    def set_search_params(self, nprobe=None, ef_search=None):
+        self._broadcast('set_search_params', nprobe, ef_search)
+
+    def close(self):
+        with self.lock:
+            for conn, worker in zip(self.conns, self.workers):
+                conn.send(None)
+                worker.join()
+            self.conns, self.workers = [], []
+
+
+def recall_report(index, embeddings, queries, k=10):
+    """Recall@k and per-query latency of `index` against exact search.
+
+    Arguments:
+        index (faiss.Index): Index built over `embeddings`.
+        embeddings (np.ndarray): Indexed vectors, for the flat baseline.
+        queries (np.ndarray): Query vectors.
+        k (int): Number of neighbours compared.
+
+    Returns:
+        dict with 'recall' (fraction of the exact top `k` that `index`
+        also returns) and 'latency_ms' / 'flat_latency_ms' per query.
+    """
+    queries = np.ascontiguousarray(queries, dtype='float32')
+    flat = build_index(embeddings, 'Flat')
+
+    start = time.monotonic()
+    _, expected = flat.search(queries, k)
+    flat_latency = time.monotonic() - start
+    start = time.monotonic()
+    _, found = index.search(queries, k)
+    latency = time.monotonic() - start
+
+    hits = sum(len(np.intersect1d(e, f)) for e, f in zip(expected, found))
+    return {
+        'recall': hits / expected.size,
+        'latency_ms': latency * 1000 / len(queries),
+        'flat_latency_ms': flat_latency * 1000 / len(queries),
+    }
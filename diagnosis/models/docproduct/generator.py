@@ -0,0 +1,417 @@
+import os
+import json
+import time
+
+import numpy as np
+import tensorflow as tf
+
+import gpt2_estimator
+from gpt2_estimator.gpt2.src import model
+
+
+def load_hparams(model_dir):
+    hparams = gpt2_estimator.default_hparams()
+    with open(os.path.join(model_dir, 'hparams.json')) as f:
+        hparams.override_from_dict(json.load(f))
+    return hparams
+
+
+def encode_stop_sequences(encoder, stop_texts):
+    """BPE ids of each stop text, alone and after a space.
+
+    BPE merges a leading space into the following token, so both variants
+    are needed to catch e.g. "`QUESTION:" right after an answer.
+    """
+    stop_sequences = []
+    for text in stop_texts:
+        for variant in (text, ' ' + text.lstrip()):
+            ids = encoder.encode(variant)
+            if ids and ids not in stop_sequences:
+                stop_sequences.append(ids)
+    return stop_sequences
+
+
+def masked_attn(x, scope, n_state, *, past, mask, hparams):
+    """`gpt2_estimator` attention with an extra key mask for left padding.
+
+    `mask` has shape [batch, past + sequence], 1 for real tokens and 0 for
+    padding, and is combined with the causal mask.
+    """
+    def split_heads(x):
+        # From [batch, sequence, features] to [batch, heads, sequence, features]
+        return tf.transpose(model.split_states(x, hparams.n_head), [0, 2, 1, 3])
+
+    def merge_heads(x):
+        return model.merge_states(tf.transpose(x, [0, 2, 1, 3]))
+
+    def mask_attn_weights(w):
+        _, _, nd, ns = model.shape_list(w)
+        b = tf.reshape(model.attention_mask(nd, ns, dtype=w.dtype),
+                       [1, 1, nd, ns])
+        b = b * tf.cast(mask[:, tf.newaxis, tf.newaxis, :], w.dtype)
+        return w * b - tf.cast(1e10, w.dtype) * (1 - b)
+
+    with tf.compat.v1.variable_scope(scope):
+        c = model.conv1d(x, 'c_attn', n_state * 3)
+        q, k, v = map(split_heads, tf.split(c, 3, axis=2))
+        present = tf.stack([k, v], axis=1)
+        if past is not None:
+            pk, pv = tf.unstack(past, axis=1)
+            k = tf.concat([pk, k], axis=-2)
+            v = tf.concat([pv, v], axis=-2)
+        w = tf.matmul(q, k, transpose_b=True)
+        w = w * tf.math.rsqrt(tf.cast(v.shape[-1], w.dtype))
+        w = model.softmax(mask_attn_weights(w))
+        a = merge_heads(tf.matmul(w, v))
+        a = model.conv1d(a, 'c_proj', n_state)
+        return a, present
+
+
+def gpt2_forward(hparams, tokens, mask, past=None):
+    """GPT-2 transformer that also consumes and returns the key/value cache.
+
+    Variables are created under the same `model/` scope as
+    `gpt2_estimator`, so the fine-tuned checkpoint restores as is.
+    Positions are counted over the real tokens of `mask`, so left-padded
+    prompts see the same positions as unpadded ones.
+
+    Returns:
+        (hidden states of `tokens`, token embedding matrix, presents of `tokens`)
+    """
+    with tf.compat.v1.variable_scope('model', reuse=tf.compat.v1.AUTO_REUSE):
+        wpe = tf.compat.v1.get_variable(
+            'wpe', [hparams.n_ctx, hparams.n_embd])
+        wte = tf.compat.v1.get_variable(
+            'wte', [hparams.n_vocab, hparams.n_embd])
+        positions = tf.maximum(tf.cumsum(mask, axis=1) - 1, 0)
+        positions = positions[:, tf.shape(mask)[1] - tf.shape(tokens)[1]:]
+        h = tf.gather(wte, tokens) + tf.gather(wpe, positions)
+
+        presents = []
+        pasts = tf.unstack(past, axis=1) if past is not None else [
+            None] * hparams.n_layer
+        for layer, layer_past in enumerate(pasts):
+            with tf.compat.v1.variable_scope('h%d' % layer):
+                nx = h.shape[-1]
+                a, present = masked_attn(
+                    model.norm(h, 'ln_1'), 'attn', nx,
+                    past=layer_past, mask=mask, hparams=hparams)
+                h = h + a
+                h = h + model.mlp(model.norm(h, 'ln_2'), 'mlp', nx * 4,
+                                  hparams=hparams)
+            presents.append(present)
+        h = model.norm(h, 'ln_f')
+    return h, wte, tf.stack(presents, axis=1)
+
+
+class GPT2Generator(object):
+    def __init__(
+            self,
+            model_dir,
+            temperature=0.7,
+            top_k=0,
+            seed=None,
+            session_config=None):
+        """Long-lived GPT-2 generation engine with incremental decoding.
+
+        Two graphs are built once and share the restored weights:
+        `prefill` runs the prompt and `step` runs only the new tokens
+        against the cached keys/values ("presents") of every layer. The
+        cache stays inside the session as a persistent tensor handle, so
+        it is never copied back to Python between steps. Prompts of a
+        batch are left-padded and masked, and finished rows are gathered
+        out of the cache.
+        """
+        super(GPT2Generator, self).__init__()
+        self.model_dir = model_dir
+        self.temperature = temperature
+        self.top_k = top_k
+        self.hparams = load_hparams(model_dir)
+        self.encoder = gpt2_estimator.encoder.get_encoder(model_dir)
+        self.eos_id = self.encoder.encoder['<|endoftext|>']
+        self.random = np.random.RandomState(seed)
+
+        self.graph = tf.Graph()
+        with self.graph.as_default():
+            self.tokens = tf.compat.v1.placeholder(
+                tf.int32, [None, None], name='tokens')
+            self.mask = tf.compat.v1.placeholder(
+                tf.int32, [None, None], name='mask')
+            self.past_handle = tf.compat.v1.placeholder(
+                tf.string, [], name='past_handle')
+            past = tf.raw_ops.GetSessionTensor(
+                handle=self.past_handle, dtype=tf.float32)
+            past.set_shape(model.past_shape(hparams=self.hparams))
+
+            # prompt: only the last position is projected onto the vocab.
+            h, wte, presents = gpt2_forward(
+                self.hparams, self.tokens, self.mask)
+            self.prefill_logits = tf.matmul(h[:, -1], wte, transpose_b=True)
+            self.prefill_cache = tf.compat.v1.get_session_handle(presents)
+
+            # new tokens against the cache.
+            h, wte, presents = gpt2_forward(
+                self.hparams, self.tokens, self.mask, past=past)
+            self.step_logits = tf.einsum('bsd,vd->bsv', h, wte)
+            self.step_cache = tf.compat.v1.get_session_handle(
+                tf.concat([past, presents], axis=-2))
+
+            # retire finished rows.
+            self.rows = tf.compat.v1.placeholder(tf.int32, [None], name='rows')
+            self.gathered_cache = tf.compat.v1.get_session_handle(
+                tf.gather(past, self.rows))
+
+            # drop rejected draft positions.
+            self.cache_length = tf.compat.v1.placeholder(
+                tf.int32, [], name='cache_length')
+            self.truncated_cache = tf.compat.v1.get_session_handle(
+                past[..., :self.cache_length, :])
+
+            saver = tf.compat.v1.train.Saver(
+                var_list=tf.compat.v1.global_variables(scope='model'))
+            self.sess = tf.compat.v1.Session(
+                graph=self.graph, config=session_config)
+            saver.restore(self.sess, tf.train.latest_checkpoint(model_dir))
+
+    def prefill(self, prompt_ids, mask):
+        """Runs the prompts and returns (next-token logits, cache handle)."""
+        return self.sess.run(
+            [self.prefill_logits, self.prefill_cache],
+            feed_dict={self.tokens: prompt_ids, self.mask: mask})
+
+    def step(self, token_ids, mask, cache):
+        """Runs `token_ids` against `cache`.
+
+        `mask` covers the cached and the new positions. Returns the logits
+        of every new position and a new cache handle; the caller owns both
+        handles and must `delete()` them when done.
+        """
+        return self.sess.run(
+            [self.step_logits, self.step_cache],
+            feed_dict={self.tokens: token_ids, self.mask: mask,
+                       self.past_handle: cache.handle})
+
+    def gather(self, cache, rows):
+        """New cache handle with only `rows` of `cache`."""
+        return self.sess.run(self.gathered_cache, feed_dict={
+            self.rows: rows, self.past_handle: cache.handle})
+
+    def truncate(self, cache, length):
+        """New cache handle with the first `length` positions of `cache`."""
+        return self.sess.run(self.truncated_cache, feed_dict={
+            self.cache_length: length, self.past_handle: cache.handle})
+
+    def pad_prompts(self, prompt_ids, max_new_tokens=1):
+        """Left-pads prompts to a shared length.
+
+        Prompts that leave less than `max_new_tokens` of the context free
+        keep their end (the question) and lose their start (the oldest
+        retrieved pairs).
+
+        Returns:
+            (tokens, mask) -- int32 arrays of shape (batch, length).
+        """
+        max_new_tokens = min(max(max_new_tokens, 1), self.hparams.n_ctx - 1)
+        max_length = self.hparams.n_ctx - max_new_tokens
+        prompt_ids = [list(p)[-max_length:] for p in prompt_ids]
+        length = max(len(p) for p in prompt_ids)
+        tokens = np.full((len(prompt_ids), length), self.eos_id, np.int32)
+        mask = np.zeros((len(prompt_ids), length), np.int32)
+        for i, p in enumerate(prompt_ids):
+            if p:
+                tokens[i, -len(p):] = p
+                mask[i, -len(p):] = 1
+        return tokens, mask
+
+    def sample(self, logits, temperature=None, top_k=None):
+        temperature = self.temperature if temperature is None else temperature
+        top_k = self.top_k if top_k is None else top_k
+        if temperature == 0 or top_k == 1:
+            return np.argmax(logits, axis=-1).astype(np.int32)
+
+        logits = logits / temperature
+        if top_k > 0:
+            min_values = np.partition(logits, -top_k, axis=-1)[:, -top_k]
+            logits = np.where(logits < min_values[:, None], -1e10, logits)
+        probs = np.exp(logits - np.max(logits, axis=-1, keepdims=True))
+        probs = np.cumsum(probs, axis=-1)
+        probs /= probs[:, -1:]
+        draws = self.random.random_sample((logits.shape[0], 1))
+        return np.sum(probs < draws, axis=-1).astype(np.int32)
+
+    def _stopped(self, output, stop_sequences):
+        """Length of the stop sequence `output` ends with, 0 if none."""
+        if output[-1] == self.eos_id:
+            return 1
+        for stop_ids in stop_sequences:
+            if output[-len(stop_ids):] == stop_ids:
+                return len(stop_ids)
+        return 0
+
+    def generate(self, prompt_ids, max_new_tokens=512, temperature=None, top_k=None, stop_sequences=(), deadline=None):
+        """Decodes after each prompt until a stop sequence or `max_new_tokens`.
+
+        Prompts are decoded together; a prompt that hits its stop condition
+        is retired from the batch so the remaining ones run on fewer rows.
+        Prompts too long to leave `max_new_tokens` of the context free are
+        cut from the front.
+
+        Arguments:
+            prompt_ids {list} -- BPE ids of one prompt, or a list of prompts
+                of any length.
+
+        Keyword Arguments:
+            max_new_tokens {int} -- Upper bound on generated tokens (default: {512})
+            temperature {float} -- Sampling temperature, 0 is greedy (default: {self.temperature})
+            top_k {int} -- Top-k truncation, 0 disables it (default: {self.top_k})
+            stop_sequences {list} -- BPE id lists that end a sequence, on top
+                of `<|endoftext|>` (default: {()})
+            deadline {float} -- `time.monotonic()` value checked between
+                decoding steps; prompts still decoding when it passes are
+                cut short (default: {None})
+
+        Returns:
+            list -- Generated ids of each prompt, stop sequence excluded, or
+                None for a prompt cut short by `deadline`.
+        """
+        if len(prompt_ids) and np.ndim(prompt_ids[0]) == 0:
+            prompt_ids = [prompt_ids]
+        tokens, mask = self.pad_prompts(prompt_ids, max_new_tokens)
+        max_new_tokens = min(max_new_tokens,
+                             self.hparams.n_ctx - tokens.shape[1])
+        stop_sequences = [list(stop_ids) for stop_ids in stop_sequences]
+
+        outputs = [[] for _ in range(tokens.shape[0])]
+        if max_new_tokens <= 0:
+            return outputs
+        if deadline is not None and time.monotonic() >= deadline:
+            return [None] * len(outputs)
+
+        # `active[row]` is the prompt decoded by `row` of the cache.
+        active = np.arange(tokens.shape[0])
+        logits, cache = self.prefill(tokens, mask)
+        try:
+            for length in range(1, max_new_tokens + 1):
+                next_ids = self.sample(logits, temperature, top_k)
+                keep = []
+                for row, i in enumerate(active):
+                    outputs[i].append(int(next_ids[row]))
+                    stop_length = self._stopped(outputs[i], stop_sequences)
+                    if stop_length:
+                        del outputs[i][-stop_length:]
+                    else:
+                        keep.append(row)
+                if not keep or length == max_new_tokens:
+                    break
+                if deadline is not None and time.monotonic() >= deadline:
+                    for row in keep:
+                        outputs[active[row]] = None
+                    break
+
+                if len(keep) < len(active):
+                    next_cache = self.gather(cache, keep)
+                    cache.delete()
+                    cache = next_cache
+                    active, mask, next_ids = active[keep], mask[keep], next_ids[keep]
+                mask = np.pad(mask, [(0, 0), (0, 1)], constant_values=1)
+                logits, next_cache = self.step(next_ids[:, None], mask, cache)
+                logits = logits[:, -1]
+                cache.delete()
+                cache = next_cache
+        finally:
+            cache.delete()
+        return outputs
+
+    def generate_speculative(self, prompt_ids, draft_ids, max_new_tokens=512, stop_sequences=(), num_draft_tokens=8, max_ngram=3, deadline=None):
+        """Greedy decoding of one prompt, drafting tokens from `draft_ids`.
+
+        The last `max_ngram` (down to 1) tokens decoded so far are looked up
+        in `draft_ids`, and the up to `num_draft_tokens` tokens that follow
+        the match are proposed as a draft. One forward pass verifies the
+        whole draft: the longest prefix that agrees with the model's argmax
+        is accepted along with the model's own next token, and the rejected
+        positions are truncated from the cache. The output is the same as
+        `generate(..., temperature=0)`, with fewer forward passes when the
+        model copies spans of `draft_ids`.
+
+        Arguments:
+            prompt_ids {list} -- BPE ids of the prompt.
+            draft_ids {list} -- BPE id lists to draft from, e.g. the
+                retrieved answers.
+
+        Returns:
+            list -- Generated ids, stop sequence excluded, or None when cut
+                short by `deadline`.
+        """
+        tokens, mask = self.pad_prompts([prompt_ids], max_new_tokens)
+        max_new_tokens = min(max_new_tokens,
+                             self.hparams.n_ctx - tokens.shape[1])
+        stop_sequences = [list(stop_ids) for stop_ids in stop_sequences]
+
+        # n-gram -> (draft, offset) of the tokens following its first
+        # occurrence in the drafts, sliced only when the n-gram is looked up.
+        draft_ids = [list(ids) for ids in draft_ids]
+        drafts = {}
+        for i, ids in enumerate(draft_ids):
+            for n in range(1, max_ngram + 1):
+                for j in range(len(ids) - n):
+                    key = tuple(ids[j:j + n])
+                    if key not in drafts:
+                        drafts[key] = (i, j + n)
+
+        output = []
+        if max_new_tokens <= 0:
+            return output
+        if deadline is not None and time.monotonic() >= deadline:
+            return None
+
+        context = list(tokens[0])
+        logits, cache = self.prefill(tokens, mask)
+        next_ids = [int(np.argmax(logits[0]))]
+        try:
+            while True:
+                for next_id in next_ids:
+                    output.append(next_id)
+                    stop_length = self._stopped(output, stop_sequences)
+                    if stop_length:
+                        del output[-stop_length:]
+                        return output
+                    if len(output) == max_new_tokens:
+                        return output
+                if deadline is not None and time.monotonic() >= deadline:
+                    return None
+
+                context.extend(next_ids)
+                draft = []
+                for n in range(min(max_ngram, len(context)), 0, -1):
+                    match = drafts.get(tuple(context[-n:]))
+                    if match is not None:
+                        i, start = match
+                        draft = draft_ids[i][start:start + min(
+                            num_draft_tokens, max_new_tokens - len(output) - 1)]
+                        break
+
+                # the last accepted token is not in the cache yet.
+                cache_length = len(context) - 1
+                step_ids = np.array([[context[-1]] + draft], np.int32)
+                logits, next_cache = self.step(
+                    step_ids, np.ones((1, len(context) + len(draft)), np.int32),
+                    cache)
+                cache.delete()
+                cache = next_cache
+
+                greedy = np.argmax(logits[0], axis=-1)
+                accepted = 0
+                while accepted < len(draft) and draft[accepted] == greedy[accepted]:
+                    accepted += 1
+                next_ids = draft[:accepted] + [int(greedy[accepted])]
+                if accepted < len(draft):
+                    next_cache = self.truncate(
+                        cache, cache_length + 1 + accepted)
+                    cache.delete()
+                    cache = next_cache
+        finally:
+            cache.delete()
+
+    def close(self):
+        self.sess.close()
@@ -69,8 +69,12 @@ class MedicalQAModelwithBert(tf.keras.Model):
             checkpoint_file=None,
             bert_trainable=True,
             layer_ind=-1,
+            pooling='mean',
             name=''):
         super(MedicalQAModelwithBert, self).__init__(name=name)
+        if pooling not in ('mean', 'masked_mean'):
+            raise ValueError(
+                "pooling is supposed to be 'mean' or 'masked_mean', got {0} instead.".format(pooling))
         build = checkpoint_file != None
         self.biobert, config = build_model_from_config(
             config_file=config_file,
@@ -93,6 +97,18 @@ class MedicalQAModelwithBert(tf.keras.Model):
             residual=residual,
             name='a_ffn')
         self.layer_ind = layer_ind
+        # 'mean' averages padding positions too and is kept for the weights
+        # and embeddings built with it; 'masked_mean' only averages real
+        # tokens, so embeddings don't depend on how much padding they got.
+        self.pooling = pooling
+
+    def _pool(self, bert_embedding, input_masks):
+        if self.pooling == 'mean':
+            return tf.reduce_mean(bert_embedding, axis=1)
+        input_masks = tf.cast(
+            input_masks, bert_embedding.dtype)[:, :, tf.newaxis]
+        return tf.reduce_sum(bert_embedding * input_masks, axis=1) / \
+            tf.maximum(tf.reduce_sum(input_masks, axis=1), 1.)
 
     def call(self, inputs):
 
@@ -109,11 +125,13 @@ class MedicalQAModelwithBert(tf.keras.Model):
         if with_question:
             q_bert_embedding = self.biobert(
                 (inputs['q_input_ids'], inputs['q_segment_ids'], inputs['q_input_masks']))[self.layer_ind]
-            q_bert_embedding = tf.reduce_mean(q_bert_embedding, axis=1)
+            q_bert_embedding = self._pool(
+                q_bert_embedding, inputs['q_input_masks'])
         if with_answer:
             a_bert_embedding = self.biobert(
                 (inputs['a_input_ids'], inputs['a_segment_ids'], inputs['a_input_masks']))[self.layer_ind]
-            a_bert_embedding = tf.reduce_mean(a_bert_embedding, axis=1)
+            a_bert_embedding = self._pool(
+                a_bert_embedding, inputs['a_input_masks'])
 
         if with_question:
             q_embedding = self.q_ffn_layer(q_bert_embedding)
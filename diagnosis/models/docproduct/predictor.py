@@ -1,22 +1,33 @@
 import os
 import re
-import json
+import threading
+import time
 
-from collections import defaultdict
 from multiprocessing import Pool, cpu_count
 
-import faiss
 import gpt2_estimator
 
 import numpy as np
-import pandas as pd
 import tensorflow as tf
 
 from tqdm import tqdm
 
+try:
+    import tensorflow_text as text
+except ImportError:
+    text = None
+
 from config.consts import FS
 from .models import MedicalQAModelwithBert
-from diagnosis.datasets.dataset import convert_text_to_feature
+from .generator import GPT2Generator, encode_stop_sequences
+from .embedding_store import (AppendedTexts, TextStore, append_text_store,
+                              check_model, copy_text_store, load_embeddings,
+                              model_fingerprint, read_model_info,
+                              write_model_info)
+from .faiss_index import (ShardedIndex, build_index, index_file, load_index,
+                          save_index, set_search_params, shard_files,
+                          supports_remove)
+from diagnosis.datasets.dataset import FeatureBuffer, convert_ids_to_features
 from diagnosis.datasets.tokenization import FullTokenizer
 from diagnosis.networks.keras_bert.loader import checkpoint_loader
 
@@ -48,8 +59,16 @@ class QAEmbed(object):
             bert_ffn_weight_file=None,
             load_pretrain=True,
             with_question=True,
-            with_answer=True):
+            with_answer=True,
+            dynamic_padding=False,
+            length_buckets=(32, 64, 128),
+            pooling='mean',
+            tokenizer_cache_size=100000):
         super(QAEmbed, self).__init__()
+        if dynamic_padding and pooling == 'mean':
+            # 'mean' averages the padding too, the embeddings would change.
+            raise ValueError(
+                "dynamic_padding=True needs pooling='masked_mean', got 'mean'.")
 
         config_file = os.path.join(pretrained_path, 'bert_config.json')
         if load_pretrain:
@@ -70,11 +89,21 @@ class QAEmbed(object):
             residual=True,
             config_file=config_file,
             checkpoint_file=checkpoint_file,
-            layer_ind=layer_ind)
+            layer_ind=layer_ind,
+            pooling=pooling)
         self.batch_size = batch_size
+        self.vocab_file = os.path.join(pretrained_path, 'vocab.txt')
+        # served questions keep reusing the same words, see FullTokenizer.
         self.tokenizer = FullTokenizer(
-            os.path.join(pretrained_path, 'vocab.txt'))
+            self.vocab_file, cache_size=tokenizer_cache_size)
         self.max_seq_length = max_seq_length
+        # pad each batch to its own longest input instead of
+        # `max_seq_length`, sorting inputs by length first.
+        self.dynamic_padding = dynamic_padding
+        self.length_buckets = length_buckets
+        # reused by every `_make_inputs` call, one per tower and thread:
+        # concurrent requests would overwrite each other's features.
+        self._local = threading.local()
 
         # build mode in order to load
         question = 'fake' if with_question else None
@@ -93,44 +122,69 @@ class QAEmbed(object):
                     'inputs are supposed to be str of list of str, got {0} instead.'.format(type(inputs)))
             return inputs
 
-    def _make_inputs(self, questions=None, answers=None, dataset=True):
-
-        if questions:
-            data_size = len(questions)
-            q_feature_dict = defaultdict(list)
-            for q in questions:
-                q_feature = convert_text_to_feature(
-                    q, tokenizer=self.tokenizer, max_seq_length=self.max_seq_length)
-                q_feature_dict['q_input_ids'].append(q_feature[0])
-                q_feature_dict['q_input_masks'].append(q_feature[1])
-                q_feature_dict['q_segment_ids'].append(q_feature[2])
-
-        if answers:
-            data_size = len(answers)
-            a_feature_dict = defaultdict(list)
-            for a in answers:
-                a_feature = convert_text_to_feature(
-                    a, tokenizer=self.tokenizer, max_seq_length=self.max_seq_length)
-                a_feature_dict['a_input_ids'].append(a_feature[0])
-                a_feature_dict['a_input_masks'].append(a_feature[1])
-                a_feature_dict['a_segment_ids'].append(a_feature[2])
-
-        if questions and answers:
-            q_feature_dict.update(a_feature_dict)
-            model_inputs = q_feature_dict
-        elif questions:
-            model_inputs = q_feature_dict
-        elif answers:
-            model_inputs = a_feature_dict
-
-        model_inputs = {k: tf.convert_to_tensor(
-            np.stack(v, axis=0)) for k, v in model_inputs.items()}
-        if dataset:
-            model_inputs = tf.data.Dataset.from_tensor_slices(model_inputs)
-            model_inputs = model_inputs.batch(self.batch_size)
-
+    def _make_features(self, questions=None, answers=None):
+        """Word piece ids of `questions` and `answers`, by tower prefix."""
+        feature_dict = {}
+        for prefix, texts in (('q_', questions), ('a_', answers)):
+            if texts:
+                feature_dict[prefix] = self.tokenizer.encode_batch(texts)
+        return feature_dict
+
+    def _padded_length(self, length):
+        """Rounds a batch length up to the next bucket to limit retracing."""
+        if not self.length_buckets:
+            return length
+        for bucket in self.length_buckets:
+            if length <= bucket:
+                return min(bucket, self.max_seq_length)
+        return self.max_seq_length
+
+    def _feature_buffer(self, prefix):
+        buffers = getattr(self._local, 'feature_buffers', None)
+        if buffers is None:
+            buffers = self._local.feature_buffers = {
+                'q_': FeatureBuffer(), 'a_': FeatureBuffer()}
+        return buffers[prefix]
+
+    def _make_inputs(self, feature_dict, rows=None, as_numpy=False):
+        """Model inputs for `rows` of `feature_dict` (all rows by default).
+
+        Without dynamic padding every feature has `max_seq_length`; with
+        it, each tower is zero-padded to its own longest row in `rows`,
+        rounded up by `_padded_length`. `as_numpy` returns int32 arrays to
+        feed instead of tensors, views into buffers that the next call
+        from the same thread overwrites.
+        """
+        model_inputs = {}
+        for prefix, token_ids in feature_dict.items():
+            if rows is not None:
+                token_ids = [token_ids[i] for i in rows]
+            features = convert_ids_to_features(
+                self.tokenizer, token_ids, self.max_seq_length,
+                dynamic_padding=self.dynamic_padding,
+                round_length=self._padded_length,
+                buffer=self._feature_buffer(prefix))
+            for key, feature in zip(('input_ids', 'input_masks', 'segment_ids'), features):
+                if not as_numpy:
+                    feature = tf.convert_to_tensor(feature)
+                model_inputs[prefix + key] = feature
         return model_inputs
 
+    def build_question_graph(self):
+        """Question tower on placeholders, for graph mode.
+
+        `predict` converts its inputs to constants and calls the model, so
+        in graph mode every call adds a new copy of the tower to the graph.
+        Build this once instead and feed `_make_inputs(..., as_numpy=True)`.
+
+        Returns:
+            (dict of input placeholders, embedding tensor)
+        """
+        placeholders = {
+            key: tf.compat.v1.placeholder(tf.int32, [None, None], name=key)
+            for key in ('q_input_ids', 'q_input_masks', 'q_segment_ids')}
+        return placeholders, self.model(placeholders)
+
     def predict(self, questions=None, answers=None, dataset=True):
 
         # type check
@@ -140,63 +194,335 @@ class QAEmbed(object):
         if questions is not None and answers is not None:
             assert len(questions) == len(answers)
 
-        model_inputs = self._make_inputs(questions, answers, dataset)
-        model_outputs = []
+        feature_dict = self._make_features(questions, answers)
+        if not dataset:
+            return self.model(self._make_inputs(feature_dict))
 
-        if dataset:
-            for batch in tqdm(iter(model_inputs), total=int(len(questions) / self.batch_size)):
-                model_outputs.append(self.model(batch))
-            model_outputs = np.concatenate(model_outputs, axis=0)
+        data_size = len(questions if questions is not None else answers)
+        if self.dynamic_padding:
+            # similar lengths end up in the same batch.
+            lengths = sum(np.array([len(ids) for ids in token_ids])
+                          for token_ids in feature_dict.values())
+            order = np.argsort(lengths, kind='stable')
         else:
-            model_outputs = self.model(model_inputs)
-        return model_outputs
+            order = np.arange(data_size)
+
+        model_outputs = []
+        for start in tqdm(range(0, data_size, self.batch_size),
+                          total=int(np.ceil(data_size / self.batch_size))):
+            rows = order[start:start + self.batch_size]
+            model_outputs.append(
+                self.model(self._make_inputs(feature_dict, rows)))
+        model_outputs = np.concatenate(model_outputs, axis=0)
+
+        # back to the order of the inputs.
+        return model_outputs[np.argsort(order)]
+
+    def export_serving(self, export_dir):
+        """Exports the question tower as a SavedModel that embeds raw strings.
+
+        See `QuestionEncoder`. Load it back with `ServingQAEmbed`. Both
+        need the optional `tensorflow_text` package, in the version that
+        matches the installed TensorFlow.
+        """
+        module = QuestionEncoder(
+            self.model, self.vocab_file, self.max_seq_length)
+        tf.saved_model.save(module, export_dir,
+                            signatures={'serving_default': module.serve})
+
+
+class QuestionEncoder(tf.Module):
+    def __init__(self, model, vocab_file, max_seq_length=256, do_lower_case=True):
+        """Traced question tower: raw strings in, embeddings out.
+
+        WordPiece lookup against the `vocab.txt` used by `FullTokenizer`,
+        BioBERT, pooling and `q_ffn` all run inside one `tf.function`, so a
+        query costs no Python-side tokenization or array building. Needs
+        `tensorflow_text`, also in the process that loads the export.
+        """
+        super(QuestionEncoder, self).__init__()
+        if text is None:
+            raise ImportError(
+                'tensorflow_text is required for the in-graph WordPiece tokenizer.')
+        self.model = model
+        self.max_seq_length = max_seq_length
+        # 'mean' pooling averages padding too, so keep QAEmbed's padding.
+        self.pad_to_max = getattr(model, 'pooling', 'mean') == 'mean'
+        self.tokenizer = text.BertTokenizer(
+            vocab_file, lower_case=do_lower_case, token_out_type=tf.int64)
+        vocab = FullTokenizer(vocab_file, do_lower_case=do_lower_case).vocab
+        self.cls_id = vocab['[CLS]']
+        self.sep_id = vocab['[SEP]']
+
+    @tf.function(input_signature=[tf.TensorSpec([None], tf.string)])
+    def serve(self, questions):
+        tokens = self.tokenizer.tokenize(questions).merge_dims(-2, -1)
+        tokens = tokens[:, :self.max_seq_length - 2]
+        batch_size = tokens.nrows()
+        input_ids = tf.concat([
+            tf.fill([batch_size, 1], tf.constant(self.cls_id, tf.int64)),
+            tokens,
+            tf.fill([batch_size, 1], tf.constant(self.sep_id, tf.int64))],
+            axis=1)
+
+        shape = [None, self.max_seq_length] if self.pad_to_max else None
+        input_masks = tf.ones_like(input_ids).to_tensor(shape=shape)
+        input_ids = input_ids.to_tensor(shape=shape)
+        embedding = self.model({
+            'q_input_ids': input_ids,
+            'q_input_masks': input_masks,
+            'q_segment_ids': tf.zeros_like(input_ids)})
+        return {'embedding': embedding}
+
+
+class ServingQAEmbed(object):
+    def __init__(self, export_dir):
+        """Question embedder loaded from `QAEmbed.export_serving`."""
+        super(ServingQAEmbed, self).__init__()
+        if text is None:
+            raise ImportError(
+                'tensorflow_text is required to load the serving signature.')
+        self.module = tf.saved_model.load(export_dir)
+        self.serve = self.module.signatures['serving_default']
+
+    def predict(self, questions=None, answers=None, dataset=True):
+        if answers is not None:
+            raise ValueError('The serving signature only embeds questions.')
+        if isinstance(questions, str):
+            questions = [questions]
+        return self.serve(tf.constant(questions))['embedding'].numpy()
 
 
 class FaissTopK(object):
-    def __init__(self, embedding_file):
+    def __init__(self, embedding_file, index_factory='Flat', nprobe=None, ef_search=None, train_size=100000, mmap=True, fingerprint=None, pooling=None, search_modes=('answer', 'question')):
         super(FaissTopK, self).__init__()
         self.embedding_file = embedding_file
-        _, ext = os.path.splitext(self.embedding_file)
-        if ext == '.pkl':
-            self.df = pd.read_pickle(self.embedding_file)
+        # see `faiss_index.build_index`, 'Flat' is exact search.
+        self.index_factory = index_factory
+        self.nprobe = nprobe
+        self.ef_search = ef_search
+        self.train_size = train_size
+        self.mmap = mmap
+        # `model_fingerprint` and pooling of the serving model, checked
+        # against an embedding store or a `save` directory.
+        self.fingerprint = fingerprint
+        self.pooling = pooling
+        check_model(self.embedding_file, fingerprint, pooling)
+        # `search_by` values served, the other index is never loaded.
+        if isinstance(search_modes, str):
+            search_modes = (search_modes,)
+        for search_by in search_modes:
+            if search_by not in ('answer', 'question'):
+                raise ValueError(
+                    'search_modes must be "answer" and/or "question", got {0}.'.format(search_by))
+        self.search_modes = tuple(search_modes)
+        # `flush` persists `add_pairs`/`remove_ids` to the directory loaded
+        # from; `dirty` is set while it has changes to write.
+        self.index_dir = None
+        self.dirty = False
+        # FAISS indexes can't be searched while rows are added or removed,
+        # and a search must gather texts from the state it searched.
+        self.lock = threading.RLock()
+        if os.path.isfile(index_file(self.embedding_file, self.search_modes[0])) or \
+                shard_files(self.embedding_file, self.search_modes[0]):
+            # indexes written by `save`, nothing to rebuild.
+            self.index_dir = self.embedding_file
+            self._load_faiss_index()
         else:
-            self.df = pd.read_parquet(self.embedding_file)
-        self._get_faiss_index()
-        # self.df.drop(columns=["Q_FFNN_embeds", "A_FFNN_embeds"], inplace=True)
+            self._get_faiss_index()
 
     def _get_faiss_index(self):
-        # with Pool(cpu_count()) as p:
-        #     question_bert = p.map(eval, self.df["Q_FFNN_embeds"].tolist())
-        #     answer_bert = p.map(eval, self.df["A_FFNN_embeds"].tolist())
-        question_bert = self.df["Q_FFNN_embeds"].tolist()
-        self.df.drop(columns=["Q_FFNN_embeds"], inplace=True)
-        answer_bert = self.df["A_FFNN_embeds"].tolist()
-        self.df.drop(columns=["A_FFNN_embeds"], inplace=True)
-        question_bert = np.array(question_bert, dtype='float32')
-        answer_bert = np.array(answer_bert, dtype='float32')
-
-        self.answer_index = faiss.IndexFlatIP(answer_bert.shape[-1])
-
-        self.question_index = faiss.IndexFlatIP(question_bert.shape[-1])
+        # texts stay lazy `TextStore`s when reading an embedding store.
+        question_bert, answer_bert, self.questions, self.answers = \
+            load_embeddings(self.embedding_file, self.search_modes)
 
-        self.answer_index.add(answer_bert)
-        self.question_index.add(question_bert)
+        self.indexes = {}
+        for search_by, embeddings in (('answer', answer_bert), ('question', question_bert)):
+            if embeddings is not None:
+                self.indexes[search_by] = build_index(
+                    embeddings, self.index_factory, self.train_size)
+        self.set_search_params(self.nprobe, self.ef_search)
 
         del answer_bert, question_bert
 
+    def _load_index(self, search_by):
+        paths = shard_files(self.embedding_file, search_by)
+        if paths:
+            # one worker process per shard, see `ShardedIndex`.
+            return ShardedIndex(paths, self.mmap)
+        return load_index(self.embedding_file, search_by, self.mmap)
+
+    def _load_faiss_index(self):
+        self.indexes = {search_by: self._load_index(search_by)
+                        for search_by in self.search_modes}
+        self.set_search_params(self.nprobe, self.ef_search)
+
+        self.questions = TextStore(self.embedding_file, 'question')
+        self.answers = TextStore(self.embedding_file, 'answer')
+
+    def _save_indexes(self, index_dir):
+        for search_by, index in self.indexes.items():
+            save_index(index, index_dir, search_by)
+
+    def save(self, index_dir):
+        """Writes the loaded indexes and the QA texts to `index_dir`.
+
+        Pass `index_dir` as `embedding_file` to load them back, memory
+        mapped unless `mmap=False`.
+        """
+        with self.lock:
+            self._save_indexes(index_dir)
+            write_model_info(index_dir, *read_model_info(self.embedding_file))
+            # stored texts are copied as bytes, never decoded.
+            copy_text_store(index_dir, 'question', self.questions)
+            copy_text_store(index_dir, 'answer', self.answers)
+
+    def _make_writable(self):
+        if len(self.indexes) < 2:
+            # the other index on disk would no longer match the texts.
+            raise ValueError(
+                'add_pairs/remove_ids need both search modes loaded.')
+        if any(isinstance(index, ShardedIndex) for index in self.indexes.values()):
+            raise ValueError(
+                'Sharded indexes are read-only, rebuild them with build_faiss_index.')
+        # memory-mapped indexes can't grow, read them into memory first.
+        if self.index_dir is not None and self.mmap:
+            self.mmap = False
+            self._load_faiss_index()
+
+    def add_pairs(self, question_embeddings, answer_embeddings, questions, answers):
+        """Adds QA pairs to the live indexes, returns their ids.
+
+        Ids continue after the last stored text. Loaded from a `save`
+        directory, the texts are appended there at once and `flush` writes
+        the indexes, so a run of updates rewrites them once; otherwise call
+        `save` to keep the new pairs. Searches wait until the pairs are
+        added.
+        """
+        assert len(questions) == len(answers) == len(question_embeddings)
+        with self.lock:
+            return self._add_pairs(
+                question_embeddings, answer_embeddings, questions, answers)
+
+    def _add_pairs(self, question_embeddings, answer_embeddings, questions, answers):
+        self._make_writable()
+        start = len(self.questions)
+        ids = np.arange(start, start + len(questions), dtype='int64')
+        self.indexes['question'].add_with_ids(
+            np.ascontiguousarray(question_embeddings, dtype='float32'), ids)
+        self.indexes['answer'].add_with_ids(
+            np.ascontiguousarray(answer_embeddings, dtype='float32'), ids)
+
+        if self.index_dir is None:
+            # stored texts stay undecoded, see `AppendedTexts`.
+            if isinstance(self.questions, AppendedTexts):
+                self.questions = self.questions.append(questions)
+                self.answers = self.answers.append(answers)
+            else:
+                self.questions = AppendedTexts(self.questions, questions)
+                self.answers = AppendedTexts(self.answers, answers)
+            return ids
+
+        # texts without index rows are never found, ids are never reused.
+        append_text_store(self.index_dir, 'question', questions)
+        append_text_store(self.index_dir, 'answer', answers)
+        self.questions = TextStore(self.index_dir, 'question')
+        self.answers = TextStore(self.index_dir, 'answer')
+        self.dirty = True
+        return ids
+
+    def remove_ids(self, ids):
+        """Drops rows from both indexes; their texts stay, ids are never reused.
+
+        Persisted by `flush`, like `add_pairs`.
+        """
+        ids = np.asarray(ids, dtype='int64')
+        with self.lock:
+            self._make_writable()
+            # checked first, a failure must not leave one index changed.
+            if not all(supports_remove(index) for index in self.indexes.values()):
+                raise ValueError(
+                    'HNSW indexes can\'t remove rows, rebuild them with build_faiss_index.')
+            for index in self.indexes.values():
+                index.remove_ids(ids)
+            if self.index_dir is not None:
+                self.dirty = True
+
+    def flush(self):
+        """Writes the indexes changed by `add_pairs`/`remove_ids` to the
+        directory they were loaded from. Nothing to do otherwise."""
+        with self.lock:
+            if self.dirty:
+                self._save_indexes(self.index_dir)
+                self.dirty = False
+
+    def close(self):
+        """`flush`es and stops the shard workers of sharded indexes."""
+        self.flush()
+        for index in self.indexes.values():
+            if isinstance(index, ShardedIndex):
+                index.close()
+
+    def set_search_params(self, nprobe=None, ef_search=None):
+        """Query-time `nprobe` (IVF) / `efSearch` (HNSW) of the loaded indexes."""
+        with self.lock:
+            for index in self.indexes.values():
+                set_search_params(index, nprobe, ef_search)
+
+    def search_batch(self, embeddings, k=5, search_by='answer', with_text=True):
+        """Top `k` rows for every row of `embeddings`, with one search.
+
+        Arguments:
+            embeddings (np.ndarray): Query embeddings, shape [n, dim].
+            k (int): Number of rows returned per query.
+            search_by (str): 'answer' or 'question' index, one of `search_modes`.
+            with_text (bool): Also gather the stored questions and answers.
+
+        Returns:
+            (ids, scores, texts): int64 and float32 arrays of shape [n, k],
+            ordered by decreasing inner product, and `texts` as a
+            (questions, answers) pair of [n, k] object arrays, or None
+            without `with_text`. FAISS pads rows it can't fill (k > ntotal,
+            removed rows, too few IVF lists or HNSW candidates visited)
+            with id -1 at the end; their texts are None.
+        """
+        if search_by not in self.indexes:
+            raise ValueError('search_by={0} is not in search_modes {1}.'.format(
+                search_by, self.search_modes))
+        embeddings = np.ascontiguousarray(embeddings, dtype='float32')
+        with self.lock:
+            scores, ids = self.indexes[search_by].search(embeddings, k)
+
+            texts = None
+            if with_text:
+                # one gather for all queries, only these rows get decoded.
+                found = ids >= 0
+                texts = []
+                for store in (self.questions, self.answers):
+                    column = np.full(ids.shape, None, dtype=object)
+                    column[found] = store[ids[found]]
+                    texts.append(column)
+                texts = tuple(texts)
+        return ids, scores, texts
+
     def predict(self, q_embedding, search_by='answer', topk=5, answer_only=True):
-        if search_by == 'answer':
-            _, index = self.answer_index.search(
-                q_embedding.astype('float32'), topk)
-        else:
-            _, index = self.question_index.search(
-                q_embedding.astype('float32'), topk)
+        return self.predict_batch(
+            q_embedding[:1], search_by, topk, answer_only)[0]
+
+    def predict_batch(self, q_embedding, search_by='answer', topk=5, answer_only=True):
+        """Same as `predict` for every row of `q_embedding`, with a single search.
+
+        Rows with fewer than `topk` neighbours return fewer texts.
+        """
+        ids, _, (questions, answers) = self.search_batch(
+            q_embedding, topk, search_by)
 
-        output_df = self.df.iloc[index[0], :]
+        found = ids >= 0
+        answers = [row[mask].tolist() for row, mask in zip(answers, found)]
         if answer_only:
-            return output_df.answer.tolist()
-        else:
-            return (output_df.question.tolist(), output_df.answer.tolist())
+            return answers
+        questions = [row[mask].tolist() for row, mask in zip(questions, found)]
+        return list(zip(questions, answers))
 
 
 class RetreiveQADoc(object):
@@ -204,19 +530,63 @@ class RetreiveQADoc(object):
                  pretrained_path=None,
                  ffn_weight_file=None,
                  bert_ffn_weight_file=FS.MODELS.BERT_FFN,
-                 embedding_file=FS.EMBEDDINGS.BERT_FFN_ZIP):
+                 embedding_file=FS.EMBEDDINGS.BERT_FFN_STORE,
+                 pooling='mean',
+                 serving_dir=None,
+                 index_factory='Flat',
+                 nprobe=None,
+                 ef_search=None,
+                 search_modes=('answer', 'question')):
         super(RetreiveQADoc, self).__init__()
-        self.qa_embed = QAEmbed(
-            pretrained_path=pretrained_path,
-            ffn_weight_file=ffn_weight_file,
-            bert_ffn_weight_file=bert_ffn_weight_file
-        )
-        self.faiss_topk = FaissTopK(embedding_file)
+        # the weights and pooling of an export aren't known.
+        fingerprint = checked_pooling = None
+        if serving_dir is not None:
+            # exported by `QAEmbed.export_serving`.
+            self.qa_embed = ServingQAEmbed(serving_dir)
+        else:
+            checked_pooling = pooling
+            fingerprint = model_fingerprint(
+                bert_ffn_weight_file or ffn_weight_file)
+            # checked against the pooling `embedding_file` was built with.
+            self.qa_embed = QAEmbed(
+                pretrained_path=pretrained_path,
+                ffn_weight_file=ffn_weight_file,
+                bert_ffn_weight_file=bert_ffn_weight_file,
+                pooling=pooling
+            )
+        self.faiss_topk = FaissTopK(
+            embedding_file, index_factory=index_factory,
+            nprobe=nprobe, ef_search=ef_search, fingerprint=fingerprint,
+            pooling=checked_pooling, search_modes=search_modes)
 
     def predict(self, questions, search_by='answer', topk=5, answer_only=True):
         embedding = self.qa_embed.predict(questions=questions)
         return self.faiss_topk.predict(embedding, search_by, topk, answer_only)
 
+    def predict_batch(self, questions, search_by='answer', topk=5, answer_only=True):
+        """`predict` for every question, with one embedding call and one search."""
+        embedding = self.qa_embed.predict(questions=questions)
+        return self.faiss_topk.predict_batch(
+            embedding, search_by, topk, answer_only)
+
+    def add_pairs(self, questions, answers):
+        """Embeds only the new QA pairs and adds them, see `FaissTopK.add_pairs`."""
+        if isinstance(self.qa_embed, ServingQAEmbed):
+            raise ValueError(
+                'A serving_dir export only embeds questions, add_pairs needs '
+                'the full QAEmbed model.')
+        questions = self.qa_embed._type_check(questions)
+        answers = self.qa_embed._type_check(answers)
+        embedding = self.qa_embed.predict(questions=questions, answers=answers)
+        return self.faiss_topk.add_pairs(
+            embedding[:, 0], embedding[:, 1], questions, answers)
+
+    def remove_ids(self, ids):
+        self.faiss_topk.remove_ids(ids)
+
+    def flush(self):
+        self.faiss_topk.flush()
+
     def getEmbedding(self, questions, search_by='answer', topk=5, answer_only=True):
         embedding = self.qa_embed.predict(questions=questions)
         return embedding
@@ -228,48 +598,60 @@ class GenerateQADoc(object):
                  ffn_weight_file=None,
                  bert_ffn_weight_file=FS.MODELS.BERT_FFN,
                  gpt2_weight_file=FS.MODELS.GPT2,
-                 embedding_file=FS.EMBEDDINGS.BERT_FFN_ZIP
+                 embedding_file=FS.EMBEDDINGS.BERT_FFN_STORE,
+                 batch_size=16,
+                 speculative=False,
+                 pooling='mean',
+                 index_factory='Flat',
+                 nprobe=None,
+                 ef_search=None,
+                 search_modes=('answer', 'question')
                  ):
         super(GenerateQADoc, self).__init__()
         tf.compat.v1.disable_eager_execution()
         session_config = tf.compat.v1.ConfigProto(
             allow_soft_placement=True)
         session_config.gpu_options.allow_growth = False
-        config = tf.estimator.RunConfig(
-            session_config=session_config)
-        self.batch_size = 1
+        # number of prompts decoded together by `predict_batch`.
+        self.batch_size = batch_size
+        # greedy decoding that drafts from the retrieved answers.
+        self.speculative = speculative
         self.gpt2_weight_file = gpt2_weight_file
-        gpt2_model_fn = gpt2_estimator.get_gpt2_model_fn(
-            accumulate_gradients=5,
-            learning_rate=0.1,
-            length=512,
-            batch_size=self.batch_size,
+        self.generator = GPT2Generator(
+            gpt2_weight_file,
             temperature=0.7,
-            top_k=0
-        )
-        hparams = gpt2_estimator.default_hparams()
-        with open(os.path.join(gpt2_weight_file, 'hparams.json')) as f:
-            hparams.override_from_dict(json.load(f))
-        self.estimator = tf.estimator.Estimator(
-            gpt2_model_fn,
-            model_dir=gpt2_weight_file,
-            params=hparams,
-            config=config)
-        self.encoder = gpt2_estimator.encoder.get_encoder(gpt2_weight_file)
+            top_k=0,
+            session_config=session_config)
+        self.encoder = self.generator.encoder
+        # an answer ends where the next `QUESTION: would start.
+        self.stop_sequences = encode_stop_sequences(
+            self.encoder, ['`QUESTION:'])
 
         config = tf.compat.v1.ConfigProto()
         config.gpu_options.allow_growth = True
-        self.embed_sess = tf.compat.v1.Session(config=config)
-        with self.embed_sess.as_default():
+        self.embed_graph = tf.Graph()
+        self.embed_sess = tf.compat.v1.Session(
+            graph=self.embed_graph, config=config)
+        with self.embed_graph.as_default(), self.embed_sess.as_default():
             self.qa_embed = QAEmbed(
                 pretrained_path=pretrained_path,
                 ffn_weight_file=ffn_weight_file,
                 bert_ffn_weight_file=bert_ffn_weight_file,
                 with_answer=False,
-                load_pretrain=False
+                load_pretrain=False,
+                pooling=pooling
             )
-
-        self.faiss_topk = FaissTopK(embedding_file)
+            self.q_placeholders, self.q_embedding = \
+                self.qa_embed.build_question_graph()
+        # queries only feed the placeholders, nothing may add ops anymore.
+        self.embed_graph.finalize()
+
+        self.faiss_topk = FaissTopK(
+            embedding_file, index_factory=index_factory,
+            nprobe=nprobe, ef_search=ef_search,
+            fingerprint=model_fingerprint(
+                bert_ffn_weight_file or ffn_weight_file),
+            pooling=pooling, search_modes=search_modes)
 
     def _get_gpt2_inputs(self, question, questions, answers):
         assert len(questions) == len(answers)
@@ -278,22 +660,29 @@ class GenerateQADoc(object):
             line = '`QUESTION: %s `ANSWER: %s ' % (q, a) + line
         return line
 
-    def predict(self, questions, search_by='answer', topk=5, answer_only=False):
-        embedding = self.qa_embed.predict(
-            questions=questions, dataset=False).eval(session=self.embed_sess)
-        if answer_only:
-            topk_answer = self.faiss_topk.predict(
-                embedding, search_by, topk, answer_only)
-        else:
-            topk_question, topk_answer = self.faiss_topk.predict(
-                embedding, search_by, topk, answer_only)
-
-        gpt2_input = self._get_gpt2_inputs(
-            questions[0], topk_question, topk_answer)
-        gpt2_pred = self.estimator.predict(
-            lambda: gpt2_estimator.predict_input_fn(inputs=gpt2_input, batch_size=self.batch_size, checkpoint_path=self.gpt2_weight_file))
-        raw_output = gpt2_estimator.predictions_parsing(
-            gpt2_pred, self.encoder)
+    def generate(self, prompt_ids, max_new_tokens=512, temperature=None, top_k=None, stop_sequences=None, deadline=None):
+        """Incrementally decodes GPT-2 tokens after `prompt_ids`.
+
+        The prompt is run once and every new token only attends to the
+        cached keys/values, see `GPT2Generator.generate`. Decoding stops at
+        `<|endoftext|>` or at the next "`QUESTION:" unless other
+        `stop_sequences` are given.
+        """
+        if stop_sequences is None:
+            stop_sequences = self.stop_sequences
+        return self.generator.generate(
+            prompt_ids, max_new_tokens=max_new_tokens,
+            temperature=temperature, top_k=top_k,
+            stop_sequences=stop_sequences, deadline=deadline)
+
+    def embed(self, questions):
+        """Question embeddings through the subgraph built at construction."""
+        feature_dict = self.qa_embed._make_features(questions=questions)
+        model_inputs = self.qa_embed._make_inputs(feature_dict, as_numpy=True)
+        return self.embed_sess.run(self.q_embedding, feed_dict={
+            self.q_placeholders[k]: v for k, v in model_inputs.items()})
+
+    def _refine(self, raw_output):
         # result_list = [re.search('`ANSWER:(.*)`QUESTION:', s)
         #                for s in raw_output]
         # result_list = [s for s in result_list if s]
@@ -301,10 +690,77 @@ class GenerateQADoc(object):
         #     r = result_list[0].group(1)
         # except (AttributeError, IndexError):
         #     r = topk_answer[0]
-        refine1 = re.sub('`QUESTION:.*?`ANSWER:','' , str(raw_output[0]) , flags=re.DOTALL)
+        refine1 = re.sub('`QUESTION:.*?`ANSWER:','' , str(raw_output) , flags=re.DOTALL)
         refine2 = refine1.split('`QUESTION: ')[0]
         return refine2
 
+    def predict(self, questions, search_by='answer', topk=5, answer_only=False, max_new_tokens=512, deadline_ms=None):
+        # the prompt always needs the retrieved questions, see `predict_batch`.
+        if answer_only:
+            raise ValueError('GenerateQADoc generates from retrieved questions '
+                             'and answers, answer_only=True is not supported.')
+        questions = self.qa_embed._type_check(questions)
+        return self.predict_batch(
+            questions[:1], search_by, topk, max_new_tokens=max_new_tokens,
+            deadline_ms=deadline_ms)[0]
+
+    def predict_batch(self, questions, search_by='answer', topk=5, max_new_tokens=512, deadline_ms=None):
+        """Generates an answer for each of `questions`.
+
+        The questions are embedded together and retrieved with one FAISS
+        search; their prompts are then decoded `batch_size` at a time, or
+        one by one with `GPT2Generator.generate_speculative` when the model
+        was built with `speculative=True`.
+
+        With `deadline_ms`, the latency budget counted from this call is
+        checked between decoding steps. A question whose generation cannot
+        finish in time gets its best retrieved answer instead, see
+        `predict_batch_with_fallback` to tell which ones did.
+        """
+        return [answer for answer, _ in self.predict_batch_with_fallback(
+            questions, search_by, topk, max_new_tokens, deadline_ms)]
+
+    def predict_batch_with_fallback(self, questions, search_by='answer', topk=5, max_new_tokens=512, deadline_ms=None):
+        """`predict_batch` as `(answer, fallback)` pairs, `fallback` is True
+        for a retrieved answer returned because `deadline_ms` passed."""
+        if deadline_ms is not None:
+            deadline = time.monotonic() + deadline_ms / 1000.
+        else:
+            deadline = None
+
+        questions = self.qa_embed._type_check(questions)
+        embedding = self.embed(questions)
+        # the GPT-2 prompt needs both the retrieved questions and answers.
+        topk_qa = self.faiss_topk.predict_batch(
+            embedding, search_by, topk, answer_only=False)
+
+        prompt_ids = [
+            self.encoder.encode(self._get_gpt2_inputs(q, topk_question, topk_answer))
+            for q, (topk_question, topk_answer) in zip(questions, topk_qa)]
+        gpt2_pred = []
+        if self.speculative:
+            for prompt, (_, topk_answer) in zip(prompt_ids, topk_qa):
+                gpt2_pred.append(self.generator.generate_speculative(
+                    prompt, [self.encoder.encode(' ' + a) for a in topk_answer],
+                    max_new_tokens=max_new_tokens,
+                    stop_sequences=self.stop_sequences, deadline=deadline))
+        else:
+            for start in range(0, len(prompt_ids), self.batch_size):
+                gpt2_pred.extend(self.generate(
+                    prompt_ids[start:start + self.batch_size],
+                    max_new_tokens=max_new_tokens, deadline=deadline))
+
+        outputs = []
+        for pred, (_, topk_answer) in zip(gpt2_pred, topk_qa):
+            if pred is None:
+                # an empty index retrieves nothing to fall back on.
+                outputs.append((topk_answer[0] if topk_answer else None, True))
+            else:
+                raw_output = gpt2_estimator.predictions_parsing(
+                    [pred], self.encoder)
+                outputs.append((self._refine(raw_output[0]), False))
+        return outputs
+
 
 if __name__ == "__main__":
     from config.util import Log
@@ -28,7 +28,7 @@ from diagnosis.models.docproduct.predictor import GenerateQADoc, RetreiveQADoc
 
 def generateQADoc(pretrained_path=FS.PRE_TRAINED.PUB_MED, ffn_weight_file=None,
                   bert_ffn_weight_file=FS.MODELS.BERT_FFN,
-                  embedding_file=FS.EMBEDDINGS.BERT_FFN_PKL):
+                  embedding_file=FS.EMBEDDINGS.BERT_FFN_STORE):
 
     doc = GenerateQADoc(pretrained_path=pretrained_path,
                         ffn_weight_file=None,
@@ -42,7 +42,7 @@ def generateQADoc(pretrained_path=FS.PRE_TRAINED.PUB_MED, ffn_weight_file=None,
 
 def retrieveQADoc(pretrained_path=FS.PRE_TRAINED.PUB_MED, ffn_weight_file=None,
                   bert_ffn_weight_file=FS.MODELS.BERT_FFN,
-                  embedding_file=FS.EMBEDDINGS.BERT_FFN_PKL):
+                  embedding_file=FS.EMBEDDINGS.BERT_FFN_STORE):
 
     doc = RetreiveQADoc(pretrained_path=pretrained_path,
                         ffn_weight_file=None,
@@ -0,0 +1,137 @@
+"""Unit-Test for the BERT TFRecord writers and input pipelines.
+
+   @project
+     File: test_dataset.py
+     Package: diagnosis.tests
+
+   @license
+     BSD-3 Clause license.
+     Copyright (c) 2019. Victor I. Afolabi. All rights reserved.
+"""
+
+# Built-in libraries.
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+import tensorflow as tf
+
+from diagnosis.datasets.dataset import (bert_serialize_fn, create_dataset_for_bert,
+                                        create_generator_for_bert, make_bert_tfrecord,
+                                        make_tfrecord, time_input_pipeline)
+from diagnosis.datasets.tokenization import FullTokenizer
+
+VOCAB = ['[PAD]', '[UNK]', '[CLS]', '[SEP]', 'my', 'eye', '##s', 'hurt',
+         'head', '##ache', '.']
+MAX_SEQ_LENGTH = 12
+
+
+def write_qa_csv(data_dir, name, count, offset=0):
+    """`count` QA pairs of varying lengths."""
+    with open(os.path.join(data_dir, name), 'w') as f:
+        f.write('question,answer\n')
+        for i in range(offset, offset + count):
+            f.write('{0},{1}\n'.format(' '.join(['my eyes hurt'] * (1 + i % 4)),
+                                       'headache .' * (1 + i % 3)))
+
+
+def make_tokenizer(data_dir):
+    vocab_file = os.path.join(data_dir, 'vocab.txt')
+    with open(vocab_file, 'w') as f:
+        f.write('\n'.join(VOCAB))
+    return FullTokenizer(vocab_file)
+
+
+def read_records(paths):
+    """Decoded `tf.train.Example`s of `paths`, in file order."""
+    return [tf.train.Example.FromString(record.numpy())
+            for path in paths for record in tf.data.TFRecordDataset(path)]
+
+
+def batches(dataset):
+    return [{k: v.numpy() for k, v in features.items()}
+            for features, _ in dataset]
+
+
+class TestBertInputPipeline(unittest.TestCase):
+    def setUp(self):
+        self.data_dir = tempfile.mkdtemp()
+        self.tokenizer = make_tokenizer(self.data_dir)
+        for i in range(2):
+            write_qa_csv(self.data_dir, 'qa{0}.csv'.format(i), 15, offset=15 * i)
+
+    def tearDown(self):
+        shutil.rmtree(self.data_dir)
+
+    def assert_same_batches(self, expected, found):
+        self.assertEqual(len(expected), len(found))
+        for e, f in zip(expected, found):
+            self.assertEqual(sorted(e), sorted(f))
+            for key in e:
+                np.testing.assert_array_equal(e[key], f[key], err_msg=key)
+
+    def test_batch_first_matches_per_example(self):
+        for dynamic_padding in (False, True):
+            make_tfrecord(self.data_dir, create_generator_for_bert, bert_serialize_fn,
+                          'BertFFN', tokenizer=self.tokenizer,
+                          max_seq_length=MAX_SEQ_LENGTH, dynamic_padding=dynamic_padding)
+            kwargs = dict(mode='eval', max_seq_length=MAX_SEQ_LENGTH, batch_size=4,
+                          dynamic_padding=dynamic_padding,
+                          # a single bucket: batches in record order.
+                          bucket_batch_sizes=[4, 4], bucket_boundaries=[1000])
+            per_example = batches(create_dataset_for_bert(self.data_dir, **kwargs))
+            batch_first = batches(create_dataset_for_bert(
+                self.data_dir, batch_first=True, **kwargs))
+            self.assertGreater(len(per_example), 1)
+            self.assert_same_batches(per_example, batch_first)
+            if not dynamic_padding:
+                self.assertEqual(per_example[0]['q_input_ids'].shape[1], MAX_SEQ_LENGTH)
+
+    def test_time_input_pipeline(self):
+        make_tfrecord(self.data_dir, create_generator_for_bert, bert_serialize_fn,
+                      'BertFFN', tokenizer=self.tokenizer, max_seq_length=MAX_SEQ_LENGTH)
+        dataset = create_dataset_for_bert(
+            self.data_dir, mode='eval', max_seq_length=MAX_SEQ_LENGTH,
+            batch_size=2, batch_first=True)
+        self.assertGreater(time_input_pipeline(dataset, num_batches=2), 0)
+        # nothing to time.
+        self.assertTrue(np.isnan(time_input_pipeline(dataset.take(0))))
+
+
+class TestMakeBertTfrecord(unittest.TestCase):
+    def setUp(self):
+        self.data_dir = tempfile.mkdtemp()
+        self.tokenizer = make_tokenizer(self.data_dir)
+        write_qa_csv(self.data_dir, 'qa.csv', 40)
+
+    def tearDown(self):
+        shutil.rmtree(self.data_dir)
+
+    def test_shards_match_make_tfrecord(self):
+        make_tfrecord(self.data_dir, create_generator_for_bert, bert_serialize_fn,
+                      'BertFFN', tokenizer=self.tokenizer, max_seq_length=MAX_SEQ_LENGTH)
+        shard_files = make_bert_tfrecord(self.data_dir, self.tokenizer, num_shards=3,
+                                         num_workers=2, max_seq_length=MAX_SEQ_LENGTH)
+        self.assertFalse([name for name in os.listdir(self.data_dir)
+                          if name.endswith('.tmp')])
+        for mode in ('train', 'eval'):
+            self.assertEqual(len(shard_files[mode]), 3)
+            expected = read_records([os.path.join(
+                self.data_dir, 'qa_BertFFN_{0}.tfrecord'.format(mode))])
+            # rows are dealt round-robin: shard i holds rows i, i + 3, ...
+            for i, path in enumerate(shard_files[mode]):
+                self.assertEqual(read_records([path]), expected[i::3])
+
+        # a shard cut short by a crash stays a `.tmp` file and is never read.
+        with open(shard_files['eval'][0] + '.tmp', 'wb') as f:
+            f.write(b'partial')
+        # the old per csv files are ignored once shards exist.
+        dataset = create_dataset_for_bert(self.data_dir, mode='eval',
+                                          max_seq_length=MAX_SEQ_LENGTH, batch_size=4)
+        self.assertEqual(sum(len(labels) for _, labels in dataset), 8)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,135 @@
+"""Unit-Test for the memory-mapped embedding & text stores.
+
+   @project
+     File: test_embedding_store.py
+     Package: diagnosis.tests
+
+   @license
+     BSD-3 Clause license.
+     Copyright (c) 2019. Victor I. Afolabi. All rights reserved.
+"""
+
+# Built-in libraries.
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+import numpy as np
+
+from diagnosis.models.docproduct.embedding_store import (
+    AppendedTexts, EmbeddingStore, TextStore, append_text_store,
+    copy_text_store, is_embedding_store, load_embeddings,
+    write_embedding_store, write_text_store)
+
+TEXTS = ['my eyes hurt', '', 'café', 'ünïcödé ✓ headache']
+
+
+class TestTextStore(unittest.TestCase):
+    def setUp(self):
+        self.store_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.store_dir)
+
+    def test_round_trip(self):
+        write_text_store(self.store_dir, 'answer', TEXTS)
+        store = TextStore(self.store_dir, 'answer')
+        self.assertEqual(len(store), len(TEXTS))
+        self.assertEqual([store[i] for i in range(len(TEXTS))], TEXTS)
+        # arrays keep their shape.
+        ids = np.array([[3, 0], [2, 2]])
+        self.assertEqual(store[ids].tolist(),
+                         [[TEXTS[3], TEXTS[0]], [TEXTS[2], TEXTS[2]]])
+
+    def test_empty(self):
+        write_text_store(self.store_dir, 'answer', [])
+        store = TextStore(self.store_dir, 'answer')
+        self.assertEqual(len(store), 0)
+        append_text_store(self.store_dir, 'answer', TEXTS[:1])
+        self.assertEqual(TextStore(self.store_dir, 'answer')[0], TEXTS[0])
+
+    def test_append(self):
+        write_text_store(self.store_dir, 'answer', TEXTS[:2])
+        append_text_store(self.store_dir, 'answer', TEXTS[2:])
+        store = TextStore(self.store_dir, 'answer')
+        self.assertEqual(store[np.arange(len(TEXTS))].tolist(), TEXTS)
+
+    def test_copy(self):
+        write_text_store(self.store_dir, 'answer', TEXTS[:3])
+        store = TextStore(self.store_dir, 'answer')
+        # appended after `store` was opened, not part of its copy.
+        append_text_store(self.store_dir, 'answer', TEXTS[3:])
+        copy_dir = os.path.join(self.store_dir, 'copy')
+        for texts, expected in ((store, TEXTS[:3]),
+                                (AppendedTexts(store, ['new']), TEXTS[:3] + ['new']),
+                                (np.array(TEXTS, dtype=object), TEXTS)):
+            # stored rows are copied as bytes.
+            with mock.patch.object(TextStore, '_decode', side_effect=AssertionError):
+                copy_text_store(copy_dir, 'question', texts)
+            copy = TextStore(copy_dir, 'question')
+            self.assertEqual(copy[np.arange(len(copy))].tolist(), expected)
+
+        # onto itself: nothing to copy.
+        store = TextStore(self.store_dir, 'answer')
+        copy_text_store(self.store_dir, 'answer', store)
+        self.assertEqual(TextStore(self.store_dir, 'answer')[np.arange(4)].tolist(), TEXTS)
+
+
+class TestEmbeddingStore(unittest.TestCase):
+    def setUp(self):
+        self.store_dir = tempfile.mkdtemp()
+        rng = np.random.RandomState(0)
+        self.questions = rng.normal(size=(4, 6))
+        self.answers = rng.normal(size=(4, 6))
+
+    def tearDown(self):
+        shutil.rmtree(self.store_dir)
+
+    def test_round_trip(self):
+        write_embedding_store(self.store_dir, self.questions, self.answers,
+                              TEXTS, TEXTS[::-1], fingerprint='abc')
+        self.assertTrue(is_embedding_store(self.store_dir))
+        store = EmbeddingStore(self.store_dir)
+        self.assertEqual((store.count, store.dim), (4, 6))
+        self.assertEqual(store.fingerprint, 'abc')
+        self.assertIsInstance(store.question_embeddings, np.memmap)
+        np.testing.assert_array_equal(
+            store.question_embeddings, self.questions.astype('float32'))
+        np.testing.assert_array_equal(
+            store.answer_embeddings, self.answers.astype('float32'))
+        self.assertEqual(store.texts('answer')[np.arange(4)].tolist(), TEXTS[::-1])
+
+    def test_float16(self):
+        write_embedding_store(self.store_dir, self.questions, self.answers,
+                              TEXTS, TEXTS, dtype='float16')
+        question_bert, answer_bert, questions, _ = load_embeddings(
+            self.store_dir, search_modes=('question',))
+        self.assertIsNone(answer_bert)
+        self.assertEqual(question_bert.dtype, np.float16)
+        np.testing.assert_array_equal(
+            question_bert, self.questions.astype('float16'))
+        self.assertEqual(questions[1], TEXTS[1])
+
+    def test_check_fingerprint(self):
+        write_embedding_store(self.store_dir, self.questions, self.answers,
+                              TEXTS, TEXTS, fingerprint='abc')
+        store = EmbeddingStore(self.store_dir)
+        store.check_fingerprint('abc')
+        store.check_fingerprint(None)
+        with self.assertRaises(ValueError):
+            store.check_fingerprint('def')
+
+    def test_check_pooling(self):
+        write_embedding_store(self.store_dir, self.questions, self.answers,
+                              TEXTS, TEXTS, fingerprint='abc', pooling='mean')
+        store = EmbeddingStore(self.store_dir)
+        self.assertEqual(store.pooling, 'mean')
+        store.check_fingerprint('abc', 'mean')
+        with self.assertRaises(ValueError):
+            store.check_fingerprint('abc', 'masked_mean')
+
+
+if __name__ == '__main__':
+    unittest.main()
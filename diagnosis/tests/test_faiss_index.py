@@ -0,0 +1,156 @@
+"""Unit-Test for sharded FAISS indexes against a single flat index.
+
+   @project
+     File: test_faiss_index.py
+     Package: diagnosis.tests
+
+   @license
+     BSD-3 Clause license.
+     Copyright (c) 2019. Victor I. Afolabi. All rights reserved.
+"""
+
+# Built-in libraries.
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from diagnosis.models.docproduct.embedding_store import write_embedding_store
+from diagnosis.models.docproduct.faiss_index import (ShardedIndex, build_index,
+                                                     build_shards, index_file,
+                                                     recall_report, save_index,
+                                                     save_shards, set_index_params,
+                                                     shard_files)
+from diagnosis.models.docproduct.predictor import FaissTopK
+
+
+class TestShardedIndex(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        rng = np.random.RandomState(0)
+        cls.embeddings = rng.normal(size=(100, 16)).astype('float32')
+        cls.queries = rng.normal(size=(20, 16)).astype('float32')
+        cls.index_dir = tempfile.mkdtemp()
+        save_shards(build_shards(cls.embeddings, 3), cls.index_dir, 'answer')
+        cls.sharded = ShardedIndex(shard_files(cls.index_dir, 'answer'))
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.sharded.close()
+        shutil.rmtree(cls.index_dir)
+
+    def test_merge_equals_flat(self):
+        self.assertEqual(self.sharded.ntotal, 100)
+        # k > rows of a shard.
+        for k in (1, 5, 50):
+            expected_scores, expected_ids = build_index(self.embeddings).search(
+                self.queries, k)
+            scores, ids = self.sharded.search(self.queries, k)
+            np.testing.assert_array_equal(ids, expected_ids)
+            np.testing.assert_allclose(scores, expected_scores, rtol=1e-5)
+
+    def test_concurrent_search(self):
+        expected = [self.sharded.search(self.queries[i:i + 1], 5)[1]
+                    for i in range(len(self.queries))]
+        with ThreadPoolExecutor(8) as pool:
+            found = list(pool.map(
+                lambda i: self.sharded.search(self.queries[i:i + 1], 5)[1],
+                range(len(self.queries))))
+        for e, f in zip(expected, found):
+            np.testing.assert_array_equal(e, f)
+
+    def test_worker_error_reaches_caller(self):
+        # wrong query dimension, the workers must keep serving afterwards.
+        with self.assertRaises(AssertionError):
+            self.sharded.search(self.queries[:, :8], 5)
+        self.assertEqual(self.sharded.search(self.queries, 5)[1].shape, (20, 5))
+
+    def test_missing_shard(self):
+        with self.assertRaises(RuntimeError):
+            ShardedIndex([os.path.join(self.index_dir, 'missing.index')])
+
+    def test_worker_skips_tensorflow(self):
+        code = 'import sys, diagnosis.faiss_worker; print("tensorflow" in sys.modules)'
+        output = subprocess.check_output([sys.executable, '-c', code])
+        self.assertEqual(output.strip(), b'False')
+
+
+class TestSaveIndex(unittest.TestCase):
+    def setUp(self):
+        self.index_dir = tempfile.mkdtemp()
+        embeddings = np.random.RandomState(0).normal(size=(10, 16))
+        # unit norm: each row is its own nearest neighbour.
+        self.embeddings = (embeddings / np.linalg.norm(
+            embeddings, axis=1, keepdims=True)).astype('float32')
+
+    def tearDown(self):
+        shutil.rmtree(self.index_dir)
+
+    def test_save_replaces_shards(self):
+        save_shards(build_shards(self.embeddings, 2), self.index_dir, 'answer')
+        save_index(build_index(self.embeddings), self.index_dir, 'answer')
+        self.assertEqual(shard_files(self.index_dir, 'answer'), [])
+        self.assertTrue(os.path.isfile(index_file(self.index_dir, 'answer')))
+
+        save_shards(build_shards(self.embeddings, 2), self.index_dir, 'answer')
+        self.assertEqual(len(shard_files(self.index_dir, 'answer')), 2)
+        self.assertFalse(os.path.isfile(index_file(self.index_dir, 'answer')))
+
+    def test_faiss_topk_save_over_shards(self):
+        store_dir = os.path.join(self.index_dir, 'store')
+        texts = ['answer {0}'.format(i) for i in range(10)]
+        write_embedding_store(store_dir, self.embeddings, self.embeddings,
+                              texts, texts)
+        for search_by in ('question', 'answer'):
+            save_shards(build_shards(self.embeddings, 2), self.index_dir, search_by)
+
+        FaissTopK(store_dir).save(self.index_dir)
+        topk = FaissTopK(self.index_dir)
+        self.assertFalse(any(isinstance(index, ShardedIndex)
+                             for index in topk.indexes.values()))
+        self.assertEqual(topk.predict(self.embeddings[3:4], topk=1), [texts[3]])
+
+
+class TestRecallReport(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        rng = np.random.RandomState(0)
+        # clustered, like real embeddings: IVF lists split along clusters.
+        centers = rng.normal(size=(8, 16))
+        cls.embeddings = (centers[rng.randint(8, size=2000)] + 0.3 * rng.normal(
+            size=(2000, 16))).astype('float32')
+        cls.queries = (centers[rng.randint(8, size=50)] + 0.3 * rng.normal(
+            size=(50, 16))).astype('float32')
+        # exact top 10 by inner product.
+        cls.expected = np.argsort(-cls.queries.dot(cls.embeddings.T), axis=1)[:, :10]
+
+    def recall(self, index):
+        _, found = index.search(self.queries, 10)
+        return np.mean([len(np.intersect1d(e, f)) / 10.
+                        for e, f in zip(self.expected, found)])
+
+    def test_recall_against_flat(self):
+        for index_factory, params in (('IVF16,Flat', dict(nprobe=2)),
+                                      ('HNSW16', dict(ef_search=16))):
+            index = set_index_params(
+                build_index(self.embeddings, index_factory), **params)
+            report = recall_report(index, self.embeddings, self.queries, k=10)
+            self.assertEqual(sorted(report), ['flat_latency_ms', 'latency_ms', 'recall'])
+            self.assertAlmostEqual(report['recall'], self.recall(index),
+                                   msg=index_factory)
+            self.assertGreater(report['recall'], 0.5, msg=index_factory)
+            self.assertGreater(report['latency_ms'], 0)
+            self.assertGreater(report['flat_latency_ms'], 0)
+
+        # probing every list is exact search.
+        index = set_index_params(build_index(self.embeddings, 'IVF16,Flat'), nprobe=16)
+        self.assertEqual(recall_report(index, self.embeddings, self.queries)['recall'], 1.)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,168 @@
+"""Unit-Test for FAISS retrieval over an embedding store.
+
+   @project
+     File: test_faiss_topk.py
+     Package: diagnosis.tests
+
+   @license
+     BSD-3 Clause license.
+     Copyright (c) 2019. Victor I. Afolabi. All rights reserved.
+"""
+
+# Built-in libraries.
+import os
+import shutil
+import tempfile
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from diagnosis.models.docproduct.embedding_store import (TextStore,
+                                                         write_embedding_store)
+from diagnosis.models.docproduct.predictor import (FaissTopK, RetreiveQADoc,
+                                                   ServingQAEmbed)
+
+
+def random_pairs(count, dim=64, seed=0):
+    """Unit-norm embeddings: each one is its own nearest neighbour."""
+    rng = np.random.RandomState(seed)
+    question_embeddings, answer_embeddings = (
+        (e / np.linalg.norm(e, axis=1, keepdims=True)).astype('float32')
+        for e in rng.normal(size=(2, count, dim)))
+    questions = ['question {0}'.format(i) for i in range(count)]
+    answers = ['answer {0}'.format(i) for i in range(count)]
+    return question_embeddings, answer_embeddings, questions, answers
+
+
+class TestFaissTopK(unittest.TestCase):
+    def setUp(self):
+        self.store_dir = tempfile.mkdtemp()
+        self.pairs = random_pairs(3)
+        write_embedding_store(self.store_dir, *self.pairs)
+
+    def tearDown(self):
+        shutil.rmtree(self.store_dir)
+
+    def test_missing_neighbours(self):
+        topk = FaissTopK(self.store_dir)
+        queries = self.pairs[1]
+
+        ids, _, (questions, answers) = topk.search_batch(queries, k=5)
+        self.assertTrue((ids[:, 3:] == -1).all())
+        self.assertTrue((answers[:, 3:] == None).all())  # noqa: E711
+        self.assertEqual(ids[0, 0], 0)
+        self.assertEqual(questions[0, 0], 'question 0')
+
+        # rows are trimmed to the neighbours found.
+        retrieved = topk.predict_batch(queries, topk=5)
+        self.assertEqual([sorted(row) for row in retrieved],
+                         [sorted(self.pairs[3])] * 3)
+        self.assertEqual(topk.predict(queries, topk=5), retrieved[0])
+
+        topk.remove_ids([0])
+        questions, answers = topk.predict(queries, topk=5, answer_only=False)
+        self.assertEqual(len(answers), 2)
+        self.assertNotIn('answer 0', answers)
+        self.assertNotIn('question 0', questions)
+
+    def test_add_pairs_in_memory(self):
+        topk = FaissTopK(self.store_dir)
+        question_embeddings, answer_embeddings, _, _ = random_pairs(2, seed=1)
+        for i in range(2):
+            ids = topk.add_pairs(question_embeddings[i:i + 1], answer_embeddings[i:i + 1],
+                                 ['new question {0}'.format(i)], ['new answer {0}'.format(i)])
+            self.assertEqual(ids.tolist(), [3 + i])
+        # stored texts are not decoded into memory.
+        self.assertIsInstance(topk.answers.base, TextStore)
+        self.assertEqual(topk.predict(answer_embeddings[1:], topk=1), ['new answer 1'])
+        self.assertEqual(topk.predict(question_embeddings[:1], search_by='question',
+                                      topk=1, answer_only=False),
+                         (['new question 0'], ['new answer 0']))
+
+        index_dir = os.path.join(self.store_dir, 'index')
+        topk.save(index_dir)
+        reloaded = FaissTopK(index_dir)
+        self.assertEqual(reloaded.answers[np.arange(5)].tolist(),
+                         self.pairs[3] + ['new answer 0', 'new answer 1'])
+        self.assertEqual(reloaded.predict(answer_embeddings[1:], topk=1), ['new answer 1'])
+
+    def test_persistence(self):
+        index_dir = os.path.join(self.store_dir, 'index')
+        FaissTopK(self.store_dir).save(index_dir)
+
+        topk = FaissTopK(index_dir)
+        question_embeddings, answer_embeddings, _, _ = random_pairs(1, seed=1)
+        ids = topk.add_pairs(question_embeddings, answer_embeddings,
+                             ['new question'], ['new answer'])
+        self.assertEqual(ids.tolist(), [3])
+        topk.remove_ids([1])
+        # indexes are only rewritten by `flush`.
+        self.assertEqual(FaissTopK(index_dir).indexes['answer'].ntotal, 3)
+        self.assertTrue(topk.dirty)
+        topk.flush()
+        self.assertFalse(topk.dirty)
+
+        reloaded = FaissTopK(index_dir)
+        self.assertEqual(len(reloaded.answers), 4)
+        self.assertEqual(reloaded.predict(answer_embeddings, topk=1), ['new answer'])
+        for search_by in ('answer', 'question'):
+            self.assertEqual(reloaded.indexes[search_by].ntotal, 3)
+        retrieved = reloaded.predict(self.pairs[1], topk=5)
+        self.assertEqual(sorted(retrieved), ['answer 0', 'answer 2', 'new answer'])
+
+    def test_add_while_searching(self):
+        topk = FaissTopK(self.store_dir)
+        question_embeddings, answer_embeddings, _, _ = random_pairs(200, seed=1)
+
+        def search(i):
+            ids, _, (_, answers) = topk.search_batch(answer_embeddings[i:i + 1], k=3)
+            # texts come from the same state as the ids.
+            return [(i, a) for i, a in zip(ids[0], answers[0]) if i >= 0]
+
+        with ThreadPoolExecutor(4) as pool:
+            searches = [pool.submit(search, i) for i in range(200)]
+            for i in range(200):
+                topk.add_pairs(question_embeddings[i:i + 1], answer_embeddings[i:i + 1],
+                               ['q{0}'.format(i)], ['a{0}'.format(i)])
+                if i % 10 == 9:
+                    topk.remove_ids([3 + i - 5])
+            for future in searches:
+                for i, answer in future.result():
+                    self.assertEqual(answer, topk.answers[i])
+        self.assertEqual(topk.indexes['answer'].ntotal, 183)
+
+    def test_hnsw_remove_ids(self):
+        topk = FaissTopK(self.store_dir, index_factory='HNSW8')
+        with self.assertRaises(ValueError):
+            topk.remove_ids([0])
+        # neither index lost the row.
+        for index in topk.indexes.values():
+            self.assertEqual(index.ntotal, 3)
+
+    def test_add_pairs_serving_dir(self):
+        # what `RetreiveQADoc(serving_dir=...)` holds, without the export.
+        doc = RetreiveQADoc.__new__(RetreiveQADoc)
+        doc.qa_embed = ServingQAEmbed.__new__(ServingQAEmbed)
+        doc.faiss_topk = FaissTopK(self.store_dir)
+        with self.assertRaises(ValueError):
+            doc.add_pairs(['new question'], ['new answer'])
+
+    def test_pooling_mismatch(self):
+        store_dir = os.path.join(self.store_dir, 'masked')
+        write_embedding_store(store_dir, *self.pairs, pooling='masked_mean')
+        FaissTopK(store_dir, pooling='masked_mean')
+        FaissTopK(store_dir)
+        with self.assertRaises(ValueError):
+            FaissTopK(store_dir, pooling='mean')
+
+        # a `save` directory keeps the store's pooling.
+        index_dir = os.path.join(self.store_dir, 'index')
+        FaissTopK(store_dir).save(index_dir)
+        FaissTopK(index_dir, pooling='masked_mean')
+        with self.assertRaises(ValueError):
+            FaissTopK(index_dir, pooling='mean')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,166 @@
+"""Unit-Test for incremental GPT-2 decoding against full recomputation.
+
+   @project
+     File: test_generator.py
+     Package: diagnosis.tests
+
+   @license
+     BSD-3 Clause license.
+     Copyright (c) 2019. Victor I. Afolabi. All rights reserved.
+"""
+
+# Built-in libraries.
+import json
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+import numpy as np
+import tensorflow as tf
+
+import gpt2_estimator
+from gpt2_estimator.gpt2.src import encoder, model
+
+from diagnosis.models.docproduct import generator as generator_module
+from diagnosis.models.docproduct.generator import GPT2Generator
+
+HPARAMS = dict(n_vocab=0, n_ctx=128, n_embd=32, n_head=4, n_layer=2)
+
+
+def make_tiny_gpt2(model_dir):
+    """Byte-level GPT-2 with random weights and a few BPE merges."""
+    vocab = {c: i for i, c in enumerate(sorted(encoder.bytes_to_unicode().values()))}
+    merges = [('Q', 'U'), ('QU', 'E'), ('A', 'N'), ('AN', 'S'), ('Ġ', '`')]
+    for first, second in merges:
+        vocab[first + second] = len(vocab)
+    vocab['<|endoftext|>'] = len(vocab)
+    hparams = dict(HPARAMS, n_vocab=len(vocab))
+    with open(os.path.join(model_dir, 'encoder.json'), 'w') as f:
+        json.dump(vocab, f)
+    with open(os.path.join(model_dir, 'vocab.bpe'), 'w') as f:
+        f.write('#version: 0.2\n' + ''.join('%s %s\n' % m for m in merges))
+    with open(os.path.join(model_dir, 'hparams.json'), 'w') as f:
+        json.dump(hparams, f)
+
+    graph = tf.Graph()
+    with graph.as_default():
+        h = gpt2_estimator.default_hparams()
+        h.override_from_dict(hparams)
+        model.model(h, tf.compat.v1.placeholder(tf.int32, [None, None]))
+        with tf.compat.v1.Session() as sess:
+            for i, var in enumerate(tf.compat.v1.global_variables(scope='model')):
+                value = np.random.RandomState(i).normal(0, 0.3, var.shape.as_list())
+                if var.name.endswith('/g:0'):
+                    value += 1
+                var.load(value.astype('float32'), sess)
+            tf.compat.v1.train.Saver().save(sess, os.path.join(model_dir, 'model.ckpt'))
+
+
+class TestGPT2Generator(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.model_dir = tempfile.mkdtemp()
+        make_tiny_gpt2(cls.model_dir)
+        cls.generator = GPT2Generator(cls.model_dir, seed=0)
+
+        # reference: the unmodified gpt2_estimator model over the whole
+        # sequence at every step.
+        hparams = gpt2_estimator.default_hparams()
+        with open(os.path.join(cls.model_dir, 'hparams.json')) as f:
+            hparams.override_from_dict(json.load(f))
+        cls.graph = tf.Graph()
+        with cls.graph.as_default():
+            cls.tokens = tf.compat.v1.placeholder(tf.int32, [1, None])
+            cls.logits = model.model(hparams, cls.tokens)['logits'][0, -1]
+            cls.sess = tf.compat.v1.Session(graph=cls.graph)
+            tf.compat.v1.train.Saver().restore(
+                cls.sess, tf.train.latest_checkpoint(cls.model_dir))
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.generator.close()
+        cls.sess.close()
+        shutil.rmtree(cls.model_dir)
+
+    def full_recompute(self, prompt_ids, max_new_tokens):
+        context, output = list(prompt_ids), []
+        for _ in range(max_new_tokens):
+            next_id = int(np.argmax(self.sess.run(
+                self.logits, feed_dict={self.tokens: [context]})))
+            if next_id == self.generator.eos_id:
+                break
+            output.append(next_id)
+            context.append(next_id)
+        return output
+
+    def encode(self, text):
+        return self.generator.encoder.encode(text)
+
+    def test_cached_greedy(self):
+        prompt = self.encode('`QUESTION: my eyes hurt `ANSWER: ')
+        self.assertEqual(
+            self.generator.generate(prompt, max_new_tokens=24, temperature=0)[0],
+            self.full_recompute(prompt, 24))
+
+    def test_left_padded_batch(self):
+        prompts = [self.encode('`QUESTION: headache `ANSWER: '),
+                   self.encode('ANS'),
+                   self.encode('`QUESTION: why do my eyes hurt so much `ANSWER: ')]
+        self.assertEqual(
+            self.generator.generate(prompts, max_new_tokens=16, temperature=0),
+            [self.full_recompute(prompt, 16) for prompt in prompts])
+
+    def test_speculative(self):
+        prompt = self.encode('`QUESTION: unaffable `ANSWER: ')
+        expected = self.full_recompute(prompt, 24)
+        for drafts in ([expected[2:20]], [expected], [[1, 2, 3, 4]], []):
+            self.assertEqual(
+                self.generator.generate_speculative(
+                    prompt, drafts, max_new_tokens=24),
+                expected)
+
+    def test_long_prompt_leaves_room(self):
+        prompt = self.encode('`QUESTION: my eyes hurt `ANSWER: headache ' * 20)
+        self.assertGreater(len(prompt), HPARAMS['n_ctx'])
+        expected = self.full_recompute(prompt[-(HPARAMS['n_ctx'] - 24):], 24)
+        self.assertEqual(
+            self.generator.generate(prompt, max_new_tokens=24, temperature=0)[0],
+            expected)
+        self.assertEqual(
+            self.generator.generate_speculative(prompt, [], max_new_tokens=24),
+            expected)
+
+    def test_deadline(self):
+        prompts = [self.encode('`QUESTION: headache `ANSWER: '),
+                   self.encode('`QUESTION: my eyes hurt `ANSWER: ')]
+        passed = time.monotonic() - 1
+        self.assertEqual(self.generator.generate(
+            prompts, max_new_tokens=16, temperature=0, deadline=passed), [None, None])
+        self.assertIsNone(self.generator.generate_speculative(
+            prompts[0], [], max_new_tokens=16, deadline=passed))
+
+        # passes after two decoding steps: prompts still decoding are cut.
+        clock = iter(range(100))
+        with mock.patch.object(generator_module.time, 'monotonic',
+                               lambda: next(clock)):
+            self.assertEqual(self.generator.generate(
+                prompts, max_new_tokens=16, temperature=0, deadline=1.5),
+                [None, None])
+
+        # a deadline that doesn't pass changes nothing.
+        later = time.monotonic() + 600
+        self.assertEqual(
+            self.generator.generate(prompts, max_new_tokens=16, temperature=0,
+                                    deadline=later),
+            [self.full_recompute(prompt, 16) for prompt in prompts])
+        self.assertEqual(
+            self.generator.generate_speculative(prompts[0], [], max_new_tokens=16,
+                                                deadline=later),
+            self.full_recompute(prompts[0], 16))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,92 @@
+"""Unit-Test for the pooling and padding of the question tower.
+
+   @project
+     File: test_qa_embed.py
+     Package: diagnosis.tests
+
+   @license
+     BSD-3 Clause license.
+     Copyright (c) 2019. Victor I. Afolabi. All rights reserved.
+"""
+
+# Built-in libraries.
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+import tensorflow as tf
+
+from diagnosis.models.docproduct.predictor import QAEmbed
+from diagnosis.tests.test_serving import VOCAB, make_tiny_bert
+
+QUESTIONS = ['My eyes hurt.', 'cafe', ' '.join(['my eyes hurt,'] * 3), 'my',
+             'head', 'Headache, my eyes hurt.']
+
+
+class TokenBert(object):
+    """Stands in for BioBERT: a fixed random vector per token id.
+
+    Padding (id 0) gets a large vector, so any pooling that averages
+    padding shows. Keras 3 pins the batch shape of a real BERT at its
+    first call, this doesn't.
+    """
+
+    def __init__(self, vocab_size, hidden_size=768):
+        embeddings = np.random.RandomState(0).normal(
+            size=(vocab_size, hidden_size)).astype(np.float32)
+        embeddings[0] = 100.
+        self.embeddings = tf.constant(embeddings)
+
+    def __call__(self, inputs):
+        token_embeddings = tf.gather(self.embeddings, inputs[0])
+        return [token_embeddings, token_embeddings]
+
+
+class TestQAEmbed(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.pretrained_path = tempfile.mkdtemp()
+        make_tiny_bert(cls.pretrained_path)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.pretrained_path)
+
+    def make_qa_embed(self, **kwargs):
+        qa_embed = QAEmbed(pretrained_path=self.pretrained_path,
+                           load_pretrain=False, with_answer=False, **kwargs)
+        qa_embed.model.biobert = TokenBert(len(VOCAB))
+        return qa_embed
+
+    def test_masked_mean_ignores_padding(self):
+        qa_embed = self.make_qa_embed(max_seq_length=8, pooling='masked_mean')
+        questions = QUESTIONS[:2]
+        short = qa_embed.predict(questions=questions)
+        qa_embed.max_seq_length = 16
+        long = qa_embed.predict(questions=questions)
+        np.testing.assert_allclose(short, long, rtol=1e-5, atol=1e-5)
+
+        # 'mean' averages the padding in, the padded length shows.
+        qa_embed.model.pooling = 'mean'
+        self.assertFalse(np.allclose(qa_embed.predict(questions=questions), long,
+                                     rtol=1e-3, atol=1e-3))
+
+    def test_dynamic_padding_keeps_input_order(self):
+        # batches of 2 across inputs of mixed lengths: sorting by length
+        # reorders them, bucketing pads each batch to its own length.
+        qa_embed = self.make_qa_embed(max_seq_length=16, pooling='masked_mean',
+                                      batch_size=2, length_buckets=(4, 8))
+        fixed = qa_embed.predict(questions=QUESTIONS)
+        qa_embed.dynamic_padding = True
+        dynamic = qa_embed.predict(questions=QUESTIONS)
+        self.assertEqual(dynamic.shape, (len(QUESTIONS), 768))
+        np.testing.assert_allclose(dynamic, fixed, rtol=1e-5, atol=1e-5)
+        # one at a time: no batch mate to swap rows with.
+        for question, embedding in zip(QUESTIONS, dynamic):
+            np.testing.assert_allclose(qa_embed.predict(questions=[question])[0],
+                                       embedding, rtol=1e-5, atol=1e-5)
+
+
+if __name__ == '__main__':
+    unittest.main()
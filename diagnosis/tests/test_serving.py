@@ -0,0 +1,84 @@
+"""Unit-Test for the raw-string serving signature of the question tower.
+
+   @project
+     File: test_serving.py
+     Package: diagnosis.tests
+
+   @license
+     BSD-3 Clause license.
+     Copyright (c) 2019. Victor I. Afolabi. All rights reserved.
+"""
+
+# Built-in libraries.
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from diagnosis.models.docproduct import predictor
+from diagnosis.models.docproduct.predictor import (QAEmbed, QuestionEncoder,
+                                                   ServingQAEmbed)
+
+VOCAB = ['[PAD]', '[UNK]', '[CLS]', '[SEP]', 'my', 'eye', '##s', 'hurt',
+         'head', '##ache', 'cafe', '.', ',']
+MAX_SEQ_LENGTH = 16
+QUESTIONS = ['My eyes hurt.', 'Héadache, CAFÉ', '',
+             # longer than `MAX_SEQ_LENGTH` word pieces.
+             ' '.join(['my eyes hurt,'] * 8)]
+
+
+def make_tiny_bert(pretrained_path):
+    """vocab.txt and a one-layer BERT config, weights stay random."""
+    with open(os.path.join(pretrained_path, 'vocab.txt'), 'w') as f:
+        f.write('\n'.join(VOCAB) + '\n')
+    # `QAEmbed` hard-codes 768 wide FFN towers with a residual connection.
+    config = dict(vocab_size=len(VOCAB), max_position_embeddings=MAX_SEQ_LENGTH,
+                  hidden_size=768, num_hidden_layers=1, num_attention_heads=2,
+                  intermediate_size=32, hidden_act='gelu', type_vocab_size=2,
+                  hidden_dropout_prob=0.1, attention_probs_dropout_prob=0.1,
+                  initializer_range=0.02)
+    with open(os.path.join(pretrained_path, 'bert_config.json'), 'w') as f:
+        json.dump(config, f)
+
+
+@unittest.skipIf(predictor.text is None, 'tensorflow_text is not installed.')
+class TestServingQAEmbed(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.pretrained_path = tempfile.mkdtemp()
+        make_tiny_bert(cls.pretrained_path)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.pretrained_path)
+
+    def test_matches_predict(self):
+        for pooling in ('mean', 'masked_mean'):
+            qa_embed = QAEmbed(pretrained_path=self.pretrained_path,
+                               load_pretrain=False, with_answer=False,
+                               max_seq_length=MAX_SEQ_LENGTH, pooling=pooling)
+            export_dir = os.path.join(self.pretrained_path, pooling)
+            qa_embed.export_serving(export_dir)
+
+            expected = qa_embed.predict(questions=QUESTIONS)
+            served = ServingQAEmbed(export_dir).predict(questions=QUESTIONS)
+            self.assertEqual(served.shape, expected.shape)
+            np.testing.assert_allclose(served, expected, rtol=1e-4, atol=1e-5,
+                                       err_msg=pooling)
+
+
+@unittest.skipIf(predictor.text is not None, 'tensorflow_text is installed.')
+class TestWithoutTensorflowText(unittest.TestCase):
+    def test_import_error(self):
+        # the serving signature is optional, the rest of predictor works.
+        with self.assertRaises(ImportError):
+            QuestionEncoder(None, 'vocab.txt')
+        with self.assertRaises(ImportError):
+            ServingQAEmbed('export_dir')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,105 @@
+"""Unit-Test for the BERT word piece tokenizer.
+
+   @author
+     Victor I. Afolabi
+     Artificial Intelligence Expert & Researcher.
+     Email: javafolabi@gmail.com
+     GitHub: https://github.com/victor-iyiola
+
+   @project
+     File: test_tokenization.py
+     Created on 02 June, 2019 @ 01:17 PM.
+
+   @license
+     BSD-3 Clause license.
+     Copyright (c) 2019. Victor I. Afolabi. All rights reserved.
+"""
+
+# Built-in libraries.
+import os
+import pickle
+import tempfile
+import unittest
+
+import numpy as np
+
+from diagnosis.datasets.dataset import FeatureBuffer, convert_texts_to_features
+from diagnosis.datasets.tokenization import FullTokenizer, WordpieceTokenizer
+
+VOCAB = ['[PAD]', '[UNK]', '[CLS]', '[SEP]', 'my', 'eye', '##s', 'hurt',
+         'head', '##ache', '##ach', 'un', '##aff', '##able', '.', '##']
+
+
+class TestWordpieceTokenizer(unittest.TestCase):
+    def setUp(self):
+        self.vocab = {token: i for i, token in enumerate(VOCAB)}
+        self.tokenizer = WordpieceTokenizer(self.vocab)
+
+    def test_longest_match(self):
+        self.assertEqual(self.tokenizer.tokenize('unaffable headache eyes'),
+                         ['un', '##aff', '##able', 'head', '##ache', 'eye', '##s'])
+
+    def test_unknown(self):
+        self.assertEqual(self.tokenizer.tokenize('unaffablex eyess'),
+                         ['[UNK]', 'eye', '##s', '##s'])
+        self.assertEqual(self.tokenizer.tokenize('ss'), ['[UNK]'])
+        self.assertEqual(WordpieceTokenizer(self.vocab, max_input_chars_per_word=3)
+                         .tokenize('head my'), ['[UNK]', 'my'])
+
+
+class TestFullTokenizer(unittest.TestCase):
+    def setUp(self):
+        fd, self.vocab_file = tempfile.mkstemp()
+        with os.fdopen(fd, 'w') as f:
+            f.write('\n'.join(VOCAB))
+        self.tokenizer = FullTokenizer(self.vocab_file)
+
+    def tearDown(self):
+        os.remove(self.vocab_file)
+
+    def test_encode_batch(self):
+        texts = ['My eyes hurt.', '', 'Headache']
+        ids = self.tokenizer.encode_batch(texts)
+        self.assertEqual(self.tokenizer.tokenize_batch(texts),
+                         [self.tokenizer.tokenize(text) for text in texts])
+        self.assertEqual([i.dtype for i in ids], [np.int32] * 3)
+        self.assertEqual([i.tolist() for i in ids],
+                         [[4, 5, 6, 7, 14], [], [8, 9]])
+
+    def test_word_cache(self):
+        cached = FullTokenizer(self.vocab_file, cache_size=2)
+        texts = ['My eyes hurt.', 'my EYES,  hurt\t', 'Héadache']
+        for text in texts:
+            self.assertEqual(cached.tokenize(text), self.tokenizer.tokenize(text))
+            self.assertEqual(cached.encode(text).tolist(),
+                             self.tokenizer.encode(text).tolist())
+        info = cached.cache_info()
+        self.assertEqual(info['size'], 2)
+        self.assertGreater(info['hits'], 0)
+        self.assertGreater(info['misses'], 0)
+
+    def test_pickle(self):
+        cached = FullTokenizer(self.vocab_file, cache_size=2)
+        cached.tokenize('My eyes hurt.')
+        copy = pickle.loads(pickle.dumps(cached))
+        self.assertEqual(copy.cache_info()['size'], 0)
+        self.assertEqual(copy.tokenize('My eyes hurt.'),
+                         cached.tokenize('My eyes hurt.'))
+        self.assertEqual(copy.cache_info()['size'], 2)
+
+    def test_convert_texts_to_features(self):
+        buffer = FeatureBuffer()
+        ids, masks, segments = convert_texts_to_features(
+            self.tokenizer, ['My eyes hurt.', 'Headache'], max_seq_length=6,
+            dynamic_padding=True, buffer=buffer)
+        self.assertEqual(ids.tolist(), [[2, 4, 5, 6, 7, 3], [2, 8, 9, 3, 0, 0]])
+        self.assertEqual(masks.tolist(), [[1] * 6, [1, 1, 1, 1, 0, 0]])
+        self.assertEqual(segments.tolist(), [[0] * 6] * 2)
+        ids, _, _ = convert_texts_to_features(
+            self.tokenizer, ['my'], max_seq_length=6, buffer=buffer)
+        self.assertEqual(ids.tolist(), [[2, 4, 3, 0, 0, 0]])
+        self.assertTrue(np.shares_memory(ids, buffer.input_ids))
+
+
+if __name__ == '__main__':
+    unittest.main()
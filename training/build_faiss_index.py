@@ -0,0 +1,65 @@
+"""Build the FAISS indexes served by `FaissTopK` ahead of time.
+
+   @author
+     Victor I. Afolabi
+     Artificial Intelligence Expert & Researcher.
+     Email: javafolabi@gmail.com
+     GitHub: https://github.com/victor-iyiola
+
+   @project
+     File: build_faiss_index.py
+     Package: training
+     Created on 5 August, 2019 @ 02:45 PM.
+
+   @license
+     BSD-3 Clause license.
+     Copyright (c) 2019. Victor I. Afolabi. All rights reserved.
+"""
+from config.consts import FS
+from diagnosis.models.docproduct.embedding_store import (copy_text_store,
+                                                         load_embeddings,
+                                                         read_model_info,
+                                                         write_model_info)
+from diagnosis.models.docproduct.faiss_index import build_shards, save_shards
+from diagnosis.models.docproduct.predictor import FaissTopK
+
+
+def build_faiss_index(embedding_file=FS.EMBEDDINGS.BERT_FFN_STORE,
+                      output_dir=FS.EMBEDDINGS.BERT_FFN_INDEX,
+                      index_factory='Flat',
+                      train_size=100000,
+                      num_shards=1):
+    """Builds the question & answer indexes once and writes them to disk.
+
+    `RetreiveQADoc`/`GenerateQADoc` given `output_dir` as `embedding_file`
+    memory-map these files instead of rebuilding the indexes at startup.
+
+    Arguments:
+        embedding_file {str} -- Output of `train_data_to_embedding` (default: {'qa_embeddings/bertffn_crossentropy_store'})
+        output_dir {str} -- Index directory (default: {'qa_embeddings/bertffn_crossentropy_index'})
+        index_factory {str} -- FAISS index factory string (default: {'Flat'})
+        train_size {int} -- Rows sampled to train the index (default: {100000})
+        num_shards {int} -- Split each index into this many row ranges, searched by
+            one worker process each when served (default: {1})
+    """
+    if num_shards == 1:
+        faiss_topk = FaissTopK(embedding_file, index_factory=index_factory,
+                               train_size=train_size)
+        faiss_topk.save(output_dir)
+        return
+
+    question_bert, answer_bert, questions, answers = load_embeddings(
+        embedding_file)
+    for search_by, embeddings in (('question', question_bert), ('answer', answer_bert)):
+        shards = build_shards(embeddings, num_shards, index_factory, train_size)
+        save_shards(shards, output_dir, search_by)
+        del shards
+    write_model_info(output_dir, *read_model_info(embedding_file))
+    # the texts of an embedding store are copied as bytes, never decoded.
+    copy_text_store(output_dir, 'question', questions)
+    copy_text_store(output_dir, 'answer', answers)
+
+
+if __name__ == "__main__":
+
+    build_faiss_index()
@@ -0,0 +1,82 @@
+"""Recall of approximate FAISS indexes against exact search.
+
+   @author
+     Victor I. Afolabi
+     Artificial Intelligence Expert & Researcher.
+     Email: javafolabi@gmail.com
+     GitHub: https://github.com/victor-iyiola
+
+   @project
+     File: evaluate_faiss_index.py
+     Package: training
+     Created on 5 August, 2019 @ 02:45 PM.
+
+   @license
+     BSD-3 Clause license.
+     Copyright (c) 2019. Victor I. Afolabi. All rights reserved.
+"""
+import faiss
+import numpy as np
+
+from config.consts import FS
+from diagnosis.models.docproduct.embedding_store import load_embeddings
+from diagnosis.models.docproduct.faiss_index import (build_index,
+                                                     recall_report,
+                                                     set_search_params)
+
+
+def evaluate_faiss_index(embedding_file=FS.EMBEDDINGS.BERT_FFN_STORE,
+                         index_factory=('IVF4096,Flat', 'SQfp16', 'SQ8'),
+                         nprobe=(1, 8, 32, 128),
+                         ef_search=(),
+                         num_queries=1000,
+                         k=10,
+                         train_size=100000):
+    """Prints recall@k, latency and size of each index against float32 flat search.
+
+    Queries are stored question embeddings sampled from `embedding_file`,
+    searched against both the question and the answer index. `nprobe` is
+    tried on IVF indexes, `ef_search` on HNSW ones.
+
+    Arguments:
+        embedding_file {str} -- Output of `train_data_to_embedding`, float32 or float16
+        index_factory {str|tuple} -- FAISS index factory string(s)
+            (default: {('IVF4096,Flat', 'SQfp16', 'SQ8')})
+        nprobe {tuple} -- IVF lists scanned per query to try (default: {(1, 8, 32, 128)})
+        ef_search {tuple} -- HNSW efSearch values to try (default: {()})
+        num_queries {int} -- Number of sampled queries (default: {1000})
+        k {int} -- Neighbours compared with the flat baseline (default: {10})
+        train_size {int} -- Rows sampled to train the index (default: {100000})
+    """
+    question_bert, answer_bert, _, _ = load_embeddings(embedding_file)
+    if isinstance(index_factory, str):
+        index_factory = (index_factory,)
+
+    rng = np.random.RandomState(42)
+    queries = question_bert[rng.choice(
+        len(question_bert), min(num_queries, len(question_bert)), replace=False)]
+
+    for name, embeddings in (('question', question_bert), ('answer', answer_bert)):
+        print('{0}: {1} x {2} {3}, float32 flat {4:.1f}MB'.format(
+            name, len(embeddings), embeddings.shape[-1], embeddings.dtype,
+            embeddings.size * 4 / 2 ** 20))
+        for factory in index_factory:
+            index = build_index(embeddings, factory, train_size)
+            size = faiss.serialize_index(index).size / 2 ** 20
+            knobs = [{}]
+            if 'IVF' in factory and nprobe:
+                knobs = [{'nprobe': n} for n in nprobe]
+            elif 'HNSW' in factory and ef_search:
+                knobs = [{'ef_search': e} for e in ef_search]
+            for knob in knobs:
+                set_search_params(index, **knob)
+                report = recall_report(index, embeddings, queries, k)
+                print('{0} {1} {2}: recall@{3} {4:.4f}, {5:.3f}ms/query (flat {6:.3f}ms/query), {7:.1f}MB'.format(
+                    name, factory, knob, k, report['recall'],
+                    report['latency_ms'], report['flat_latency_ms'], size))
+            del index
+
+
+if __name__ == "__main__":
+
+    evaluate_faiss_index()
@@ -0,0 +1,83 @@
+"""Soak test of the GenerateQADoc question embedding path.
+
+   @author
+     Victor I. Afolabi
+     Artificial Intelligence Expert & Researcher.
+     Email: javafolabi@gmail.com
+     GitHub: https://github.com/victor-iyiola
+
+   @project
+     File: soak_embedding.py
+     Package: training
+     Created on 5 August, 2019 @ 02:45 PM.
+
+   @license
+     BSD-3 Clause license.
+     Copyright (c) 2019. Victor I. Afolabi. All rights reserved.
+"""
+import os
+import resource
+import time
+
+from config.consts import FS
+from diagnosis.models.docproduct.predictor import GenerateQADoc
+
+
+def _rss_mb():
+    """Current resident set size in MB (peak RSS where /proc is missing)."""
+    try:
+        with open('/proc/self/statm') as f:
+            pages = int(f.read().split()[1])
+        return pages * os.sysconf('SC_PAGE_SIZE') / 2 ** 20
+    except (OSError, ValueError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2 ** 10
+
+
+def soak_embedding(pretrained_path=FS.PRE_TRAINED.PUB_MED,
+                   bert_ffn_weight_file=FS.MODELS.BERT_FFN,
+                   gpt2_weight_file=FS.MODELS.GPT2,
+                   embedding_file=FS.EMBEDDINGS.BERT_FFN_STORE,
+                   num_queries=100000, batch_size=1, log_every=5000):
+    """Prints RSS, mean latency and graph op count every `log_every` queries.
+
+    All three should stay flat: the embedding graph is finalized and every
+    query only feeds placeholders.
+
+    Arguments:
+        pretrained_path {str} -- BioBERT config and vocab directory
+        bert_ffn_weight_file {str} -- Trained BertFFN weights
+        gpt2_weight_file {str} -- Trained GPT-2 weights
+        embedding_file {str} -- Output of `train_data_to_embedding`
+        num_queries {int} -- Queries embedded in total (default: {100000})
+        batch_size {int} -- Questions per query (default: {1})
+        log_every {int} -- Queries between reports (default: {5000})
+    """
+    doc = GenerateQADoc(pretrained_path=pretrained_path,
+                        ffn_weight_file=None,
+                        bert_ffn_weight_file=bert_ffn_weight_file,
+                        gpt2_weight_file=gpt2_weight_file,
+                        embedding_file=embedding_file)
+    questions = ['my eyes hurts and i have a headache.'] * batch_size
+    doc.embed(questions)  # warmup
+
+    num_ops = len(doc.embed_graph.get_operations())
+    print('start: rss {:.1f}MB, {} ops'.format(_rss_mb(), num_ops))
+    done = logged = 0
+    start = time.monotonic()
+    while done < num_queries:
+        doc.embed(questions)
+        done += batch_size
+        # `batch_size` need not divide `log_every`: report once a multiple
+        # of it is passed, averaging over the queries since the last one.
+        if done // log_every > logged // log_every or done >= num_queries:
+            elapsed = time.monotonic() - start
+            print('{} queries: rss {:.1f}MB, {:.2f}ms/query, {} ops'.format(
+                done, _rss_mb(), elapsed * 1000 / (done - logged),
+                len(doc.embed_graph.get_operations())))
+            logged = done
+            start = time.monotonic()
+
+
+if __name__ == "__main__":
+
+    soak_embedding()
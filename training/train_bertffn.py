@@ -26,7 +26,7 @@ import tensorflow.keras.backend as K
 
 from config.consts import FS
 
-from diagnosis.datasets.dataset import create_dataset_for_bert
+from diagnosis.datasets.dataset import InputPipelineReport, create_dataset_for_bert
 from diagnosis.datasets.tokenization import FullTokenizer
 
 from diagnosis.models.docproduct.models import MedicalQAModelwithBert
@@ -43,7 +43,10 @@ def train_bertffn(model_path=FS.MODELS.BERT_FFN,
                   validation_split=0.2,
                   loss='categorical_crossentropy',
                   pretrained_path=FS.PRE_TRAINED.PUB_MED,
-                  max_seq_len=256):
+                  max_seq_len=256,
+                  pooling='mean',
+                  batch_first=False,
+                  input_report=False):
     """A function to train BertFFNN similarity embedding model.
 
     Input file format:
@@ -64,6 +67,9 @@ def train_bertffn(model_path=FS.MODELS.BERT_FFN,
         loss {str} -- Loss type, either MSE or crossentropy (default: {'categorical_crossentropy'})
         pretrained_path {str} -- Pretrained bioBert model path (default: {'models/pubmed_pmc_470k/'})
         max_seq_len {int} -- Max sequence length of model(No effects if dynamic padding is enabled) (default: {256})
+        pooling {str} -- 'mean' over all positions or 'masked_mean' over real tokens only (default: {'mean'})
+        batch_first {bool} -- Parse whole batches in parallel instead of bucketing examples by length, see `create_dataset_for_bert` (default: {False})
+        input_report {bool} -- Print whether training is input or compute bound after every epoch, see `InputPipelineReport` (default: {False})
     """
     tf.compat.v1.disable_eager_execution()
     # if loss == 'categorical_crossentropy':
@@ -79,7 +85,8 @@ def train_bertffn(model_path=FS.MODELS.BERT_FFN,
         batch_size=batch_size,
         shuffle_buffer=500_000,
         dynamic_padding=True,
-        max_seq_length=max_seq_len
+        max_seq_length=max_seq_len,
+        batch_first=batch_first
     )
     eval_d = create_dataset_for_bert(
         data_path, tokenizer=tokenizer,
@@ -87,12 +94,14 @@ def train_bertffn(model_path=FS.MODELS.BERT_FFN,
         mode='eval',
         dynamic_padding=True,
         max_seq_length=max_seq_len,
-        bucket_batch_sizes=[64, 64, 64]
+        bucket_batch_sizes=[64, 64, 64],
+        batch_first=batch_first
     )
 
     medical_qa_model = MedicalQAModelwithBert(
         config_file=os.path.join(pretrained_path, 'bert_config.json'),
-        checkpoint_file=os.path.join(pretrained_path, 'biobert_model.ckpt')
+        checkpoint_file=os.path.join(pretrained_path, 'biobert_model.ckpt'),
+        pooling=pooling
     )
     optimizer = tf.keras.optimizers.Adam(lr=learning_rate)
 
@@ -112,7 +121,20 @@ def train_bertffn(model_path=FS.MODELS.BERT_FFN,
         period=1
     )
 
-    medical_qa_model.fit(d, epochs=epochs, callbacks=[callback])
+    callbacks = [callback]
+    if input_report:
+        # timed on its own unshuffled copy of the training data.
+        report_d = create_dataset_for_bert(
+            data_path, tokenizer=tokenizer,
+            batch_size=batch_size,
+            dynamic_padding=True,
+            max_seq_length=max_seq_len,
+            batch_first=batch_first,
+            shuffle=False
+        )
+        callbacks.append(InputPipelineReport(report_d))
+
+    medical_qa_model.fit(d, epochs=epochs, callbacks=callbacks)
     medical_qa_model.summary()
     medical_qa_model.save_weights(model_path)
     medical_qa_model.evaluate(eval_d)
@@ -24,6 +24,8 @@ import numpy as np
 import pandas as pd
 
 from config.consts import FS
+from diagnosis.models.docproduct.embedding_store import (model_fingerprint,
+                                                         write_embedding_store)
 from diagnosis.models.docproduct.predictor import QAEmbed
 
 
@@ -48,8 +50,11 @@ def read_all(data_path):
 
 def train_data_to_embedding(model_path=FS.MODELS.BERT_FFN,
                             data_path=FS.DATA.MQA,
-                            output_path=FS.EMBEDDINGS.BERT_FFN_ZIP,
-                            pretrained_path=FS.PRE_TRAINED.PUB_MED):
+                            output_path=FS.EMBEDDINGS.BERT_FFN_STORE,
+                            pretrained_path=FS.PRE_TRAINED.PUB_MED,
+                            pooling='mean',
+                            dynamic_padding=False,
+                            dtype='float32'):
     """Function to generate similarity embeddings for QA pairs.
 
     Input file format:
@@ -59,8 +64,15 @@ def train_data_to_embedding(model_path=FS.MODELS.BERT_FFN,
     Arguments:
         model_path {str} -- Similarity embedding model path (default: {'models/bertffn_crossentropy/bertffn'})
         data_path {str} -- CSV data path (default: {'data/mqa_csv'})
-        output_path {str} -- Embedding output path (default: {'qa_embeddings/bertffn_crossentropy.zip'})
+        output_path {str} -- Embedding store directory, or a .zip/.parquet/.pkl file for the old
+            list-column format (default: {'qa_embeddings/bertffn_crossentropy_store'})
         pretrained_path {str} -- Pretrained BioBert model path (default: {'models/pubmed_pmc_470k/'})
+        pooling {str} -- 'mean' over all positions or 'masked_mean' over real tokens only.
+            Switching to 'masked_mean' means re-running this over the whole corpus and
+            serving with the same pooling (default: {'mean'})
+        dynamic_padding {bool} -- Pad each batch to its longest QA pair, needs
+            'masked_mean' pooling (default: {False})
+        dtype {str} -- 'float32' or 'float16' embedding store matrices (default: {'float32'})
     """
     # FFN & BERT-FFN weight files.
     ffn_weight_file = model_path if os.path.basename(
@@ -71,7 +83,9 @@ def train_data_to_embedding(model_path=FS.MODELS.BERT_FFN,
     embeder = QAEmbed(
         pretrained_path=pretrained_path,
         ffn_weight_file=ffn_weight_file,
-        bert_ffn_weight_file=bert_ffn_weight_file
+        bert_ffn_weight_file=bert_ffn_weight_file,
+        pooling=pooling,
+        dynamic_padding=dynamic_padding
     )
 
     qa_df = read_all(data_path)
@@ -82,6 +96,15 @@ def train_data_to_embedding(model_path=FS.MODELS.BERT_FFN,
     )
 
     q_embedding, a_embedding = np.split(qa_vectors, 2, axis=1)
+    _, ext = os.path.splitext(output_path)
+    if ext not in ('.zip', '.parquet', '.pkl'):
+        write_embedding_store(
+            output_path, np.squeeze(q_embedding, axis=1), np.squeeze(a_embedding, axis=1),
+            qa_df.question.tolist(), qa_df.answer.tolist(),
+            fingerprint=model_fingerprint(model_path), dtype=dtype,
+            pooling=pooling)
+        return
+
     qa_df['Q_FFNN_embeds'] = np.squeeze(q_embedding).tolist()
     qa_df['A_FFNN_embeds'] = np.squeeze(a_embedding).tolist()
     os.makedirs(os.path.dirname(output_path), exist_ok=True)
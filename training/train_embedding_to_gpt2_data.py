@@ -28,9 +28,10 @@ import pandas as pd
 from tqdm import tqdm
 
 from config.consts import FS
+from diagnosis.models.docproduct.embedding_store import load_embeddings
 
 def train_embedding_to_gpt2_data(
-        data_path=FS.EMBEDDINGS.BERT_FFN_ZIP,
+        data_path=FS.EMBEDDINGS.BERT_FFN_STORE,
         output_path=FS.EMBEDDINGS.BERT_FFN_GPT2,
         number_samples=10,
         batch_size=512,
@@ -42,36 +43,27 @@ def train_embedding_to_gpt2_data(
         https://github.com/Santosh-Gupta/DocProduct/blob/master/README.md
 
     Arguments:
-        data_path {str} -- Embedding data path, usually the output file of train_data_to_embedding (default: {'qa_embeddings/bertffn_crossentropy.zip'})
+        data_path {str} -- Embedding data path, usually the output of train_data_to_embedding (default: {'qa_embeddings/bertffn_crossentropy_store'})
         output_path {str} -- GPT2 training data output path (default: {'gpt2_train_data/bertffn_crossentropy_gpt2_train_data.zip'})
         number_samples {int} -- Number of sample per question (default: {10})
         batch_size {int} -- Retreive batch size of FAISS (default: {512})
 
     """
-    _, ext = os.path.splitext(data_path)
-    if ext == '.pkl':
-        qa = pd.read_pickle(data_path)
-    else:
-        qa = pd.read_parquet(data_path)
-    # qa = pd.read_parquet(data_path)
-
-    question_bert = qa["Q_FFNN_embeds"].tolist()
-    answer_bert = qa["A_FFNN_embeds"].tolist()
-    question_bert = np.array(question_bert)
-    answer_bert = np.array(answer_bert)
-
-    question_bert = question_bert.astype('float32')
-    answer_bert = answer_bert.astype('float32')
-
-    answer_index = faiss.IndexFlatIP(answer_bert.shape[-1])
-    question_index = faiss.IndexFlatIP(question_bert.shape[-1])
-
+    # questions are always the queries, answers only needed to search by them.
+    question_bert, answer_bert, questions, answers = load_embeddings(
+        data_path, search_modes=('question', search_by))
+    # normalized in place below, so copy out of a read-only embedding store.
+    question_bert = np.array(question_bert, dtype='float32')
     faiss.normalize_L2(question_bert)
-    faiss.normalize_L2(answer_bert)
-
-    answer_index.add(answer_bert)
+    question_index = faiss.IndexFlatIP(question_bert.shape[-1])
     question_index.add(question_bert)
 
+    if search_by == 'answer':
+        answer_bert = np.array(answer_bert, dtype='float32')
+        faiss.normalize_L2(answer_bert)
+        answer_index = faiss.IndexFlatIP(answer_bert.shape[-1])
+        answer_index.add(answer_bert)
+
     os.makedirs(os.path.dirname(output_path), exist_ok=True)
 
     df_dict = defaultdict(list)
@@ -86,10 +78,10 @@ def train_embedding_to_gpt2_data(
                 question_bert[start_ind:end_ind].astype('float32'), topk)
             return I2
 
-    steps = ceil(qa.shape[0] / batch_size)
+    steps = ceil(len(questions) / batch_size)
 
     # for k in tqdm(range(1000), mininterval=30, maxinterval=60):
-    for k in tqdm(range(0, qa.shape[0], batch_size), total=steps):
+    for k in tqdm(range(0, len(questions), batch_size), total=steps):
         start_ind = k
         end_ind = k + batch_size
 
@@ -98,14 +90,14 @@ def train_embedding_to_gpt2_data(
                                     search_by=search_by)
 
         for i, a_index in enumerate(a_batch_index):
-            df_dict['question'].append(qa["question"].iloc[k + i])
-            df_dict['answer'].append(qa["answer"].iloc[k + i])
+            df_dict['question'].append(questions[k + i])
+            df_dict['answer'].append(answers[k + i])
 
             for ii in range(number_samples):
                 df_dict['question{0}'.format(ii)].append(
-                    qa.question.iloc[a_index[ii]])
+                    questions[a_index[ii]])
                 df_dict['answer{0}'.format(ii)].append(
-                    qa.answer.iloc[a_index[ii]])
+                    answers[a_index[ii]])
 
     df = pd.DataFrame(df_dict)
     df.to_parquet(output_path, index=False)